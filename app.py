@@ -1,22 +1,27 @@
 import os
-from flask import Flask, request, jsonify, render_template
-import requests
+from flask import Flask, request, render_template
 import sqlite3
-from queue import Queue
+from queue import Empty, Queue
 import threading
 import time
 from datetime import datetime, timedelta, timezone
 import hashlib
+import math
 import json
 import re
-from io import BytesIO
 import base64
-from zhipuai import ZhipuAI
+import gzip
+import secrets
+import struct
+import atexit
+from cachetools import TTLCache
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives import padding
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import padding as asym_padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from priv_sets import (
     LLM_API_KEY,
@@ -24,19 +29,171 @@ from priv_sets import (
     PROCESS_TIMEOUT,
     LLM_MODEL,
     RSA_PRIVATE_KEY,
-    OCR_API_PREFIX,
+    OCR_API_PREFIXES,
     RSA_PUBLIC_KEY,
     MAX_OCR_CONCURRENCY,
     MAX_REQUEST_CONCURRENCY,
+    OCR_CONCURRENCY_BOUNDS,
+    LLM_ROUTES,
+    LLM_FALLBACK_MODELS,
+    LLM_CONCURRENCY,
+    LLM_CONCURRENCY_BOUNDS,
+    ADMIN_TOKEN,
 )
-from prompts import DOC_PROMPT, FORM_PROMPT, FILL_PROMPT
+from concurrency_limit import AdaptiveLimiter, classify_failure
+from file_lib_store import FileLibStore, StoredFileLib
+from form_prefill import build_index, prefill_form
+from llm_router import (
+    FakeProvider,
+    LatencyStats,
+    LLMCancelled,
+    LLMRouter,
+    ZhipuProvider,
+)
+from ocr_pool import OCRPool
+from page_dedup import BLANK, DUPLICATE, UNIQUE, classify_pages
+from profiler import (
+    SlowTaskProfiler,
+    bind,
+    format_collapsed,
+    list_profiles,
+    sample,
+)
+from prompts import DOC_PROMPT, FORM_PROMPT, FILL_PROMPT, REPAIR_PROMPT
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 PRINT_MESSAGES = os.environ.get("PRINT_MESSAGE", "false").lower() == "true"
+LLM_PROVIDER = os.environ.get("LLM_PROVIDER", "zhipu").lower()
+
+MAX_BATCH_SIZE = 500
+MAX_BATCH_RESPONSE_BYTES = 8 * 1024 * 1024
+
+ENVELOPE_CONTENT_TYPE = "application/vnd.docusnap.envelope"
+ENVELOPE_MAGIC = b"DSNP"
+ENVELOPE_VERSIONS = [1]
+
+COMPRESS_MIN_BYTES = 1024
+
+CHECKPOINT_EXPIRE_MINUTES = 60
+TASK_MAX_ATTEMPTS = 3
+TASK_RETRY_BACKOFF_SECONDS = 2
+RETRYABLE_ERRORS = ["OCR_FAILURE", "LLM_FAILURE", "PROCESSING_ERROR"]
+
+PARTIAL_UPDATE_INTERVAL = 1.0
+PARTIAL_FIELDS = ["title", "tags", "description", "kv", "fields"]
+
+LLM_REPAIR_RETRIES = 1
+MAX_JSON_SCAN = 50
+
+# Expected top-level keys of the LLM output per task type. Keys with a
+# default are filled in locally; the others are re-requested if missing.
+LLM_OUTPUT_SCHEMAS = {
+    "doc": {
+        "title": (str, None),
+        "tags": (list, None),
+        "description": (str, None),
+        "kv": (dict, None),
+        "related": (list, []),
+    },
+    "form": {
+        "title": (str, None),
+        "tags": (list, None),
+        "description": (str, None),
+        "kv": (dict, None),
+        "fields": (list, None),
+        "related": (list, []),
+    },
+}
+
+SESSION_TTL_SECONDS = 3600
+MAX_SESSIONS = 10000
+
+TASK_CACHE_SIZE = 1000
+TASK_CACHE_SECONDS = 30
+# Unfinished rows of tasks queued in another worker process may change
+# there without this process knowing.
+STATUS_CACHE_SECONDS = 1
+ACCESS_FLUSH_SECONDS = 5
+
+PROFILE_DIR = "profiles"
+MAX_PROFILE_SECONDS = 60
+DEFAULT_PROFILE_INTERVAL_MS = 10
+SLOW_TASK_PROFILE_SECONDS = 60
+MAX_SLOW_TASK_PROFILES = 50
+
+# Skip OCR of blank pages and of pages that repeat an earlier page.
+PAGE_DEDUP = True
+
+# How often running tasks check whether another process cleared them.
+CANCEL_CHECK_SECONDS = 2
+
+# ETA guesses until enough tasks have run to measure the stages.
+DEFAULT_STAGE_SECONDS = {"ocr_page": 2.0, "llm": 10.0}
+MAX_RETRY_AFTER_SECONDS = 15
 
 app = Flask(__name__)
 task_queue = Queue()
-client = ZhipuAI(api_key=LLM_API_KEY)
-ocr_semaphore = threading.Semaphore(MAX_OCR_CONCURRENCY)
+# Created by start_runtime() in each process, see "Lifecycle" below.
+llm_router = None
+ocr_pool = OCRPool(OCR_API_PREFIXES)
+# The OCR limits in priv_sets are per endpoint.
+ocr_limiter = AdaptiveLimiter(
+    "ocr",
+    MAX_OCR_CONCURRENCY * len(OCR_API_PREFIXES),
+    OCR_CONCURRENCY_BOUNDS[0],
+    OCR_CONCURRENCY_BOUNDS[1] * len(OCR_API_PREFIXES),
+)
+# Sessions are stored in tasks.db, shared by all worker processes. This
+# is a read cache of key_id -> (client_id, aes_key, expires_at).
+session_keys = TTLCache(maxsize=MAX_SESSIONS, ttl=SESSION_TTL_SECONDS)
+session_lock = threading.Lock()
+# Hot task rows, (client_id, sha256, type) -> (row, stored_at). Writers in
+# this process invalidate entries; TTLs bound staleness from other processes.
+task_cache = TTLCache(maxsize=TASK_CACHE_SIZE, ttl=TASK_CACHE_SECONDS)
+task_cache_lock = threading.Lock()
+task_cache_stats = {"hits": 0, "misses": 0}
+# Bumped by every invalidation, so a row read before a write is not cached.
+task_cache_epoch = 0
+page_stats = {"pages": 0, "ocr": 0, "duplicate": 0, "blank": 0}
+page_stats_lock = threading.Lock()
+# Cancel events of queued and running tasks, by (client_id, sha256, type).
+task_cancel_events = {}
+task_cancel_lock = threading.Lock()
+task_stats = {"cancelled": 0, "deadline_exceeded": 0}
+# Estimated seconds and start time of queued and running tasks, by key.
+task_work = {}
+# Rolling durations of "ocr_page" and "llm:<type>", for ETAs.
+stage_stats = LatencyStats()
+# Pending last_accessed updates, flushed by access_flusher().
+pending_access = {}
+access_lock = threading.Lock()
+rsa_private_key = None
+# Created by preload(); their at-rest keys are derived from the RSA key.
+file_lib_store = None
+session_aead = None
+rsa_key_lock = threading.Lock()
+runtime_lock = threading.Lock()
+runtime_pid = None
+profile_lock = threading.Lock()
+slow_task_profiler = SlowTaskProfiler(
+    SLOW_TASK_PROFILE_SECONDS,
+    DEFAULT_PROFILE_INTERVAL_MS / 1000,
+    PROFILE_DIR,
+    MAX_SLOW_TASK_PROFILES,
+)
+
+
+# Columns added after the first release; init_db adds them to older DBs.
+ADDED_TASK_COLUMNS = [
+    ("result_version", "TEXT"),
+    ("stage", "TEXT"),
+    ("partial", "TEXT"),
+    ("eta_at", "REAL"),
+]
 
 
 def init_db():
@@ -53,6 +210,10 @@ def init_db():
             error_detail TEXT,
             created_at TEXT,
             last_accessed TEXT,
+            result_version TEXT,
+            stage TEXT,
+            partial TEXT,
+            eta_at REAL,
             PRIMARY KEY (client_id, sha256, type)
         )
     """
@@ -62,13 +223,53 @@ def init_db():
         CREATE INDEX IF NOT EXISTS idx_client_sha ON tasks (client_id, sha256)
     """
     )
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            client_id TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            type TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            data TEXT NOT NULL,
+            created_at TEXT,
+            PRIMARY KEY (client_id, sha256, type, stage)
+        )
+    """
+    )
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS file_libs (
+            client_id TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            data TEXT NOT NULL
+        )
+    """
+    )
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            key_id TEXT PRIMARY KEY,
+            client_id TEXT NOT NULL,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    """
+    )
+    c.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_session_expiry
+        ON sessions (expires_at)
+    """
+    )
+    c.execute("PRAGMA table_info(tasks)")
+    columns = {row[1] for row in c.fetchall()}
+    for name, definition in ADDED_TASK_COLUMNS:
+        if name not in columns:
+            c.execute(f"ALTER TABLE tasks ADD COLUMN {name} {definition}")
     conn.commit()
     conn.close()
 
 
-init_db()
-
-
 def log_message(message_type, data):
     if PRINT_MESSAGES:
         try:
@@ -85,6 +286,8 @@ def log_message(message_type, data):
 def log_request():
     if PRINT_MESSAGES and request.endpoint in [
         "unified_process",
+        "batch_process",
+        "create_session",
         "clear_cache",
     ]:
         log_data = {
@@ -97,10 +300,46 @@ def log_request():
         log_message("REQUEST RECEIVED", log_data)
 
 
+def compress_body(raw, accept_encoding):
+    """Compress a response body if it is large and the client accepts it"""
+    if len(raw) < COMPRESS_MIN_BYTES:
+        return raw, None
+    accepted = [
+        token.split(";")[0].strip().lower()
+        for token in (accept_encoding or "").split(",")
+    ]
+    if brotli is not None and "br" in accepted:
+        return brotli.compress(raw), "br"
+    if "gzip" in accepted:
+        return gzip.compress(raw, compresslevel=5), "gzip"
+    return raw, None
+
+
+@app.after_request
+def compress_response(response):
+    if (
+        response.direct_passthrough
+        or response.mimetype != "application/json"
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+    raw = response.get_data()
+    compressed, encoding = compress_body(
+        raw, request.headers.get("Accept-Encoding")
+    )
+    if encoding:
+        response.set_data(compressed)
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
 @app.after_request
 def log_response(response):
     if PRINT_MESSAGES and request.endpoint in [
         "unified_process",
+        "batch_process",
+        "create_session",
         "clear_cache",
     ]:
         resp_data = {
@@ -119,16 +358,38 @@ def get_current_utc_time():
     return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
 
 
-RSA_PRIVATE_KEY_OBJ = serialization.load_pem_private_key(
-    RSA_PRIVATE_KEY.encode(), password=None, backend=default_backend()
-)
+def get_rsa_private_key():
+    global rsa_private_key
+    with rsa_key_lock:
+        if rsa_private_key is None:
+            rsa_private_key = serialization.load_pem_private_key(
+                RSA_PRIVATE_KEY.encode(),
+                password=None,
+                backend=default_backend(),
+            )
+        return rsa_private_key
+
+
+def server_key(info):
+    """At-rest key for the stored data named by info, from the RSA key"""
+    der = get_rsa_private_key().private_bytes(
+        serialization.Encoding.DER,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=info,
+    ).derive(der)
 
 
 def rsa_decrypt_key(encrypted_key_b64):
     """Decrypt AES key using RSA"""
     try:
         ciphertext = base64.b64decode(encrypted_key_b64)
-        return RSA_PRIVATE_KEY_OBJ.decrypt(
+        return get_rsa_private_key().decrypt(
             ciphertext,
             asym_padding.OAEP(
                 mgf=asym_padding.MGF1(algorithm=hashes.SHA256()),
@@ -141,14 +402,21 @@ def rsa_decrypt_key(encrypted_key_b64):
         raise
 
 
-def aes_encrypt(data, key):
+def aes_encrypt(data, key, cipher_mode="cbc"):
+    return base64.b64encode(aes_encrypt_bytes(data, key, cipher_mode)).decode()
+
+
+def aes_encrypt_bytes(data, key, cipher_mode="cbc"):
     if isinstance(key, bytes):
         key = key
     else:
         key = key.encode("utf-8")
-    iv = os.urandom(16)
     if isinstance(data, str):
         data = data.encode("utf-8")
+    if cipher_mode == "gcm":
+        nonce = os.urandom(12)
+        return nonce + AESGCM(key).encrypt(nonce, data, None)
+    iv = os.urandom(16)
     padder = padding.PKCS7(128).padder()
     padded_data = padder.update(data) + padder.finalize()
     cipher = Cipher(
@@ -158,15 +426,24 @@ def aes_encrypt(data, key):
     )
     encryptor = cipher.encryptor()
     ciphertext = encryptor.update(padded_data) + encryptor.finalize()
-    return base64.b64encode(iv + ciphertext).decode()
+    return iv + ciphertext
+
+
+def aes_decrypt(encrypted_data, key, cipher_mode="cbc"):
+    return aes_decrypt_bytes(
+        base64.b64decode(encrypted_data), key, cipher_mode
+    )
 
 
-def aes_decrypt(encrypted_data, key):
+def aes_decrypt_bytes(encrypted_bytes, key, cipher_mode="cbc"):
     if isinstance(key, bytes):
         key = key
     else:
         key = key.encode("utf-8")
-    encrypted_bytes = base64.b64decode(encrypted_data)
+    if cipher_mode == "gcm":
+        nonce = encrypted_bytes[:12]
+        ciphertext = encrypted_bytes[12:]
+        return AESGCM(key).decrypt(nonce, ciphertext, None)
     iv = encrypted_bytes[:16]
     ciphertext = encrypted_bytes[16:]
     cipher = Cipher(
@@ -180,24 +457,136 @@ def aes_decrypt(encrypted_data, key):
     return unpadder.update(padded_data) + unpadder.finalize()
 
 
-def perform_ocr_base64(image_base64):
-    with ocr_semaphore:
+def parse_envelope(raw):
+    """Parse a binary upload envelope into a /process request dict.
+
+    Layout (integers big-endian):
+        b"DSNP" | u8 version | u32 header length | header JSON | sections
+    The header carries the JSON request fields except `content`. Each
+    section is a u32 length followed by encrypted bytes: the first is the
+    encrypted inner JSON without `to_process`, the rest are the encrypted
+    pages. SHA256 is computed over all section bytes.
+    """
+    if len(raw) < 9 or raw[:4] != ENVELOPE_MAGIC:
+        raise ValueError("INVALID_ENVELOPE")
+    version = raw[4]
+    if version not in ENVELOPE_VERSIONS:
+        raise ValueError("UNSUPPORTED_ENVELOPE_VERSION")
+    (header_len,) = struct.unpack_from(">I", raw, 5)
+    body_start = 9 + header_len
+    if body_start > len(raw):
+        raise ValueError("INVALID_ENVELOPE")
+    try:
+        data = json.loads(raw[9:body_start])
+    except Exception:
+        raise ValueError("INVALID_ENVELOPE")
+    if not isinstance(data, dict):
+        raise ValueError("INVALID_ENVELOPE")
+
+    body = memoryview(raw)[body_start:]
+    sections = []
+    pos = 0
+    while pos < len(body):
+        if pos + 4 > len(body):
+            raise ValueError("INVALID_ENVELOPE")
+        (section_len,) = struct.unpack_from(">I", body, pos)
+        pos += 4
+        if pos + section_len > len(body):
+            raise ValueError("INVALID_ENVELOPE")
+        sections.append(body[pos : pos + section_len])
+        pos += section_len
+
+    data["envelope_version"] = version
+    if sections:
+        data["content"] = body
+        data["sections"] = sections
+    return data
+
+
+def register_session_key(client_id, aes_key_bytes):
+    """Store a session key where every worker process can look it up"""
+    key_id = secrets.token_urlsafe(16)
+    now = time.time()
+    expires_at = now + SESSION_TTL_SECONDS
+    nonce = os.urandom(12)
+    data = base64.b64encode(
+        nonce
+        + session_aead.encrypt(
+            nonce, aes_key_bytes, f"{key_id}:{client_id}".encode()
+        )
+    ).decode()
+    with sqlite3.connect("tasks.db") as conn:
+        conn.execute("DELETE FROM sessions WHERE expires_at < ?", (now,))
+        conn.execute(
+            "INSERT INTO sessions (key_id, client_id, data, expires_at) "
+            "VALUES (?, ?, ?, ?)",
+            (key_id, client_id, data, expires_at),
+        )
+        # Over the cap, drop the sessions that expire first.
+        conn.execute(
+            """
+            DELETE FROM sessions WHERE key_id IN (
+                SELECT key_id FROM sessions
+                ORDER BY expires_at DESC
+                LIMIT -1 OFFSET ?
+            )
+            """,
+            (MAX_SESSIONS,),
+        )
+    with session_lock:
+        session_keys[key_id] = (client_id, aes_key_bytes, expires_at)
+    return key_id
+
+
+def lookup_session_key(client_id, key_id):
+    """Return the AES key registered under key_id, or None if unknown"""
+    with session_lock:
+        entry = session_keys.get(key_id)
+    if entry is None:
+        with sqlite3.connect("tasks.db") as conn:
+            row = conn.execute(
+                "SELECT client_id, data, expires_at FROM sessions "
+                "WHERE key_id = ?",
+                (key_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        raw = base64.b64decode(row[1])
         try:
-            image_bytes = base64.b64decode(image_base64)
-            image_file = BytesIO(image_bytes)
-            r = requests.post(
-                f"{OCR_API_PREFIX}/ocr",
-                files={"image": ("", image_file, "image/png")},
-                timeout=60,
+            aes_key_bytes = session_aead.decrypt(
+                raw[:12], raw[12:], f"{key_id}:{row[0]}".encode()
             )
-            r.raise_for_status()
-            out = r.json()["results"]
-            rst = " ".join([item["text"] for item in out])
-            app.logger.info("OCR completed successfully")
-            return rst
-        except Exception as e:
-            app.logger.error(f"OCR processing failed: {str(e)}")
-            raise
+        except Exception:
+            app.logger.error("Stored session key failed to decrypt")
+            return None
+        entry = (row[0], aes_key_bytes, row[2])
+        with session_lock:
+            session_keys[key_id] = entry
+    if entry[0] != client_id or entry[2] < time.time():
+        return None
+    return entry[1]
+
+
+def perform_ocr(image, cancel_event=None):
+    """OCR one page, given as raw image bytes or a base64 string"""
+    if isinstance(image, str):
+        image_bytes = base64.b64decode(image)
+    else:
+        image_bytes = image
+    if not ocr_limiter.acquire(cancel_event):
+        raise ValueError("TASK_CANCELLED")
+    start = time.monotonic()
+    try:
+        out = ocr_pool.ocr(image_bytes)
+        rst = " ".join([item["text"] for item in out])
+    except Exception as e:
+        overload, retry_after = classify_failure(e)
+        ocr_limiter.release(overload=overload, retry_after=retry_after)
+        app.logger.error(f"OCR processing failed: {str(e)}")
+        raise
+    ocr_limiter.release(time.monotonic() - start)
+    app.logger.info("OCR completed successfully")
+    return rst
 
 
 def expand_json(data, parent_key="", separator="."):
@@ -217,45 +606,243 @@ def expand_json(data, parent_key="", separator="."):
     return items
 
 
-def call_llm(prompt, type):
+def call_llm(
+    prompt,
+    type,
+    pages=0,
+    output=None,
+    on_output=None,
+    on_delta=None,
+    cancel_event=None,
+):
+    """Run the LLM stage; output skips the completion call (resume)"""
     try:
-        response = client.chat.asyncCompletions.create(
-            model=LLM_MODEL,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0,
-            response_format={"type": "json_object"},
-            thinking={"type": "disabled"},
-        )
-        task_id = response.id
-        while True:
-            result_response = (
-                client.chat.asyncCompletions.retrieve_completion_result(
-                    id=task_id
-                )
+        if output is None:
+            model, output = llm_router.complete(
+                prompt,
+                type,
+                pages,
+                cancel_event=cancel_event,
+                on_delta=on_delta,
             )
-            if result_response.task_status == "SUCCESS":
-                if PRINT_MESSAGES:
-                    app.logger.debug(
-                        f"LLM raw output: \n{result_response.choices[0].message.content}"
-                    )
-                rst = remove_think_tags(
-                    result_response.choices[0].message.content
-                )
-                app.logger.info("LLM processing completed successfully")
-                if type != "fill":
-                    rst = json.loads(rst)
-                    rst["kv"] = expand_json(rst["kv"])
-                    rst = json.dumps(rst)
-                return rst
-            elif result_response.task_status == "FAILED":
-                app.logger.error("LLM processing failed")
-                raise Exception("LLM processing failed")
-            time.sleep(1)
+            if PRINT_MESSAGES:
+                app.logger.debug(f"LLM raw output ({model}): \n{output}")
+            if on_output:
+                on_output(output)
+        else:
+            model = "checkpoint"
+        try:
+            rst, missing = parse_llm_output(output, type)
+        except ValueError as e:
+            app.logger.warning(f"LLM output not parseable: {str(e)}")
+            rst, missing = {}, list(LLM_OUTPUT_SCHEMAS.get(type, {}))
+            if type == "fill":
+                missing = ["*"]
+
+        for _ in range(LLM_REPAIR_RETRIES):
+            if not missing:
+                break
+            app.logger.info(f"Re-requesting missing LLM output: {missing}")
+            rst, missing = repair_llm_output(
+                prompt, type, pages, rst, missing, cancel_event
+            )
+        if missing:
+            raise ValueError(f"LLM output missing {missing}")
+
+        app.logger.info(f"LLM processing completed successfully on {model}")
+        if type != "fill":
+            rst["kv"] = expand_json(rst["kv"])
+        return json.dumps(rst)
+    except LLMCancelled:
+        app.logger.info("LLM call cancelled")
+        raise
     except Exception as e:
         app.logger.error(f"LLM call failed: {str(e)}")
         raise
 
 
+def repair_llm_output(
+    prompt, type, pages, partial, missing, cancel_event=None
+):
+    """Ask the LLM again for just the missing keys and merge them in"""
+    if missing == ["*"]:
+        repair_prompt = prompt
+    else:
+        repair_prompt = (
+            prompt
+            + REPAIR_PROMPT
+            + "  <partial_output>  "
+            + json.dumps(partial)
+            + "</partial_output>  <missing_keys>"
+            + json.dumps(missing)
+            + "</missing_keys>"
+        )
+    _, output = llm_router.complete(
+        repair_prompt, type, pages, cancel_event=cancel_event
+    )
+    try:
+        patch = extract_json_object(remove_think_tags(output))
+    except ValueError as e:
+        app.logger.warning(f"LLM repair output not parseable: {str(e)}")
+        return partial, missing
+    if missing != ["*"]:
+        patch = {key: patch[key] for key in missing if key in patch}
+    return validate_llm_output({**partial, **patch}, type)
+
+
+def parse_llm_output(output, type):
+    """Extract and validate the LLM output.
+
+    Returns (result, missing keys); raises ValueError if the output holds
+    no JSON object at all.
+    """
+    return validate_llm_output(
+        extract_json_object(remove_think_tags(output)), type
+    )
+
+
+def extract_json_object(text):
+    """Return the first JSON object in text, repairing common defects"""
+    text = re.sub(r"```(?:json)?", "", text)
+    decoder = json.JSONDecoder()
+    start = text.find("{")
+    if start == -1:
+        raise ValueError("No JSON object in LLM output")
+    try:
+        obj, _ = decoder.raw_decode(text, start)
+        if isinstance(obj, dict):
+            return obj
+    except ValueError:
+        pass
+    try:
+        obj = json.loads(repair_json(text[start:]))
+        if isinstance(obj, dict):
+            return obj
+    except ValueError:
+        pass
+    for _ in range(MAX_JSON_SCAN):
+        start = text.find("{", start + 1)
+        if start == -1:
+            break
+        try:
+            obj, _ = decoder.raw_decode(text, start)
+            if isinstance(obj, dict):
+                return obj
+        except ValueError:
+            continue
+    raise ValueError("No valid JSON object in LLM output")
+
+
+def repair_json(text):
+    """Fix smart quotes, trailing commas, trailing text and truncation"""
+    text = text.replace("\u201c", '"').replace("\u201d", '"')
+    text = re.sub(r",\s*([}\]])", r"\1", text)
+    stack = []
+    in_string = False
+    escaped = False
+    end = len(text)
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            if not stack:
+                end = i + 1
+                break
+    text = text[:end]
+    if in_string:
+        text += '"'
+    text = text.rstrip().rstrip(",")
+    if text.endswith(":"):
+        text += " null"
+    return text + "".join(reversed(stack))
+
+
+def parse_partial_output(text):
+    """Return the completed top-level fields of a streaming JSON output"""
+    text = remove_think_tags(text)
+    start = text.find("{")
+    if start == -1:
+        return {}
+    stack = []
+    in_string = False
+    escaped = False
+    safe_end = None
+    safe_stack = []
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            safe_end, safe_stack = i + 1, list(stack)
+            if not stack:
+                break
+        elif ch == ",":
+            safe_end, safe_stack = i, list(stack)
+    if safe_end is None:
+        return {}
+    try:
+        obj = json.loads(text[start:safe_end] + "".join(reversed(safe_stack)))
+    except ValueError:
+        return {}
+    if not isinstance(obj, dict):
+        return {}
+    fields = {key: obj[key] for key in PARTIAL_FIELDS if key in obj}
+    if isinstance(fields.get("kv"), dict):
+        fields["kv"] = expand_json(fields["kv"])
+    return fields
+
+
+def validate_llm_output(obj, type):
+    """Coerce obj towards the schema of type; returns (obj, missing keys)"""
+    if type == "fill":
+        return {
+            field: entry
+            for field, entry in obj.items()
+            if isinstance(entry, dict)
+            and "value" in entry
+            and entry["value"] not in [None, ""]
+            and isinstance(entry.get("source"), dict)
+        }, []
+
+    missing = []
+    for key, (expected, default) in LLM_OUTPUT_SCHEMAS[type].items():
+        value = obj.get(key)
+        if expected is list and isinstance(value, str):
+            value = [value]
+        if not isinstance(value, expected):
+            if default is None:
+                missing.append(key)
+                obj.pop(key, None)
+                continue
+            value = default
+        obj[key] = value
+    return obj, missing
+
+
 def cleanup_old_entries():
     current_time = datetime.now(timezone.utc)
 
@@ -265,6 +852,11 @@ def cleanup_old_entries():
     timeout_cutoff = current_time - timedelta(minutes=PROCESS_TIMEOUT)
     timeout_cutoff_str = timeout_cutoff.strftime("%Y-%m-%d %H:%M:%S")
 
+    checkpoint_cutoff = current_time - timedelta(
+        minutes=CHECKPOINT_EXPIRE_MINUTES
+    )
+    checkpoint_cutoff_str = checkpoint_cutoff.strftime("%Y-%m-%d %H:%M:%S")
+
     conn = sqlite3.connect("tasks.db")
     c = conn.cursor()
 
@@ -285,6 +877,11 @@ def cleanup_old_entries():
             (expire_cutoff_str,),
         )
 
+        c.execute(
+            "DELETE FROM checkpoints WHERE created_at < ? ",
+            (checkpoint_cutoff_str,),
+        )
+
         conn.commit()
     except Exception as e:
         app.logger.error(f"Cleanup failed: {str(e)}")
@@ -297,6 +894,19 @@ def remove_think_tags(input_string):
     return re.sub(pattern, "", input_string, flags=re.DOTALL)
 
 
+def file_lib_text(file_lib):
+    """file_lib as prompt JSON; stored libraries arrive pre-serialized"""
+    if isinstance(file_lib, StoredFileLib):
+        return file_lib.text
+    return json.dumps(file_lib)
+
+
+def file_lib_index(file_lib):
+    if isinstance(file_lib, StoredFileLib):
+        return file_lib.index
+    return build_index(file_lib)
+
+
 def construct_prompt_doc(doc_text, file_lib):
     try:
         app.logger.info("Constructing document prompt")
@@ -305,7 +915,7 @@ def construct_prompt_doc(doc_text, file_lib):
             + "  <ocr_content>  "
             + doc_text
             + "</ocr_content>  <file_lib>"
-            + json.dumps(file_lib)
+            + file_lib_text(file_lib)
             + "</file_lib>"
         )
     except Exception as e:
@@ -321,7 +931,7 @@ def construct_prompt_form(form_text, file_lib):
             + "  <ocr_content>  "
             + form_text
             + "</ocr_content>  <file_lib>"
-            + json.dumps(file_lib)
+            + file_lib_text(file_lib)
             + "</file_lib>"
         )
     except Exception as e:
@@ -337,7 +947,7 @@ def construct_prompt_fill(form_obj, file_lib):
             + "  <form>  "
             + json.dumps(form_obj)
             + "</form>  <file_lib>"
-            + json.dumps(file_lib)
+            + file_lib_text(file_lib)
             + "</file_lib>"
         )
     except Exception as e:
@@ -345,17 +955,87 @@ def construct_prompt_fill(form_obj, file_lib):
         raise ValueError("FILL_PROMPT_CONSTRUCTION_FAILED")
 
 
-def images_to_text(images):
+def prepare_fill(task, content):
+    """Pre-fill what the file_lib resolves; returns (prefilled, prompt).
+
+    The prompt asks only for the remaining fields and is None when no field
+    is left for the LLM. The pre-filled fields are checkpointed so that a
+    resumed task can merge them into the LLM result.
+    """
+    prefilled, form_obj = prefill_form(
+        content["to_process"], file_lib_index(content["file_lib"])
+    )
+    if prefilled:
+        app.logger.info(f"Pre-filled {len(prefilled)} fields locally")
+        write_checkpoint(task, "prefill", json.dumps(prefilled))
+    if form_obj is None:
+        return prefilled, None
+    return prefilled, construct_prompt_fill(form_obj, content["file_lib"])
+
+
+def merge_prefill(result, prefilled):
+    if not prefilled:
+        return result
+    return json.dumps({**json.loads(result), **prefilled})
+
+
+def record_page_kinds(kinds):
+    with page_stats_lock:
+        page_stats["pages"] += len(kinds)
+        for kind, _ in kinds:
+            page_stats["ocr" if kind == UNIQUE else kind] += 1
+    skipped = len(kinds) - sum(1 for kind, _ in kinds if kind == UNIQUE)
+    if skipped:
+        app.logger.info(
+            f"Skipping OCR of {skipped} of {len(kinds)} pages "
+            "(blank or duplicate)"
+        )
+
+
+def images_to_text(images, done_pages=None, on_page=None, cancel_event=None):
+    """OCR all pages; pages in done_pages (index -> text) are not redone.
+
+    Blank pages and repeats of an earlier page are not OCR-ed; they keep
+    their page number in the text with a short note instead. Once
+    cancel_event is set, pages that have not started are dropped.
+    """
     try:
-        with ThreadPoolExecutor() as executor:
+        pages = [
+            base64.b64decode(img) if isinstance(img, str) else img
+            for img in images
+        ]
+        if PAGE_DEDUP:
+            kinds = classify_pages(pages)
+        else:
+            kinds = [(UNIQUE, None)] * len(pages)
+        record_page_kinds(kinds)
+        texts = [None] * len(pages)
+        for i, text in (done_pages or {}).items():
+            if i < len(texts):
+                texts[i] = text
+        for i, (kind, original) in enumerate(kinds):
+            if kind == DUPLICATE:
+                texts[i] = f"(same as page {original + 1})"
+            elif kind == BLANK:
+                texts[i] = "(blank page)"
+        errors = []
+        with ThreadPoolExecutor(thread_name_prefix="ocr") as executor:
             futures = {
-                executor.submit(perform_ocr_base64, img): i
-                for i, img in enumerate(images)
+                executor.submit(bind(perform_ocr), page, cancel_event): i
+                for i, page in enumerate(pages)
+                if texts[i] is None
             }
-            texts = [None] * len(images)
             for future in as_completed(futures):
                 idx = futures[future]
-                texts[idx] = future.result()
+                try:
+                    texts[idx] = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                if on_page:
+                    on_page(idx, texts[idx])
+        if errors:
+            raise errors[0]
         combined_text = ""
         for i, text in enumerate(texts):
             combined_text += f"\n----page {i+1}----\n{text}"
@@ -365,6 +1045,173 @@ def images_to_text(images):
         raise
 
 
+def write_checkpoint(task, stage, data):
+    """Store a stage output, encrypted with the task key"""
+    try:
+        encrypted = aes_encrypt(data, task["aes_key"], "gcm")
+        with sqlite3.connect("tasks.db") as conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO checkpoints (
+                    client_id,
+                    sha256,
+                    type,
+                    stage,
+                    data,
+                    created_at
+                ) VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    task["client_id"],
+                    task["sha256"],
+                    task["type"],
+                    stage,
+                    encrypted,
+                    get_current_utc_time(),
+                ),
+            )
+            conn.commit()
+    except Exception as e:
+        app.logger.error(f"Failed to write checkpoint {stage}: {str(e)}")
+
+
+def read_checkpoints(task):
+    """Return stage -> output for checkpoints decryptable with the task key"""
+    checkpoints = {}
+    try:
+        with sqlite3.connect("tasks.db") as conn:
+            rows = conn.execute(
+                """
+                SELECT stage, data
+                FROM checkpoints
+                WHERE client_id = ?
+                AND sha256 = ?
+                AND type = ?
+                """,
+                (task["client_id"], task["sha256"], task["type"]),
+            ).fetchall()
+    except Exception as e:
+        app.logger.error(f"Failed to read checkpoints: {str(e)}")
+        return checkpoints
+    for stage, data in rows:
+        try:
+            checkpoints[stage] = aes_decrypt(
+                data, task["aes_key"], "gcm"
+            ).decode("utf-8")
+        except Exception:
+            app.logger.warning(f"Checkpoint {stage} not readable, ignored")
+    return checkpoints
+
+
+def delete_checkpoints(client_id, sha256=None, task_type=None, stage=None):
+    try:
+        query = "DELETE FROM checkpoints WHERE client_id = ?"
+        params = [client_id]
+        for column, value in [
+            ("sha256", sha256),
+            ("type", task_type),
+            ("stage", stage),
+        ]:
+            if value is not None:
+                query += f" AND {column} = ?"
+                params.append(value)
+        with sqlite3.connect("tasks.db") as conn:
+            conn.execute(query, params)
+            conn.commit()
+    except Exception as e:
+        app.logger.error(f"Failed to delete checkpoints: {str(e)}")
+
+
+def cached_task(client_id, sha256, task_type):
+    key = (client_id, sha256, task_type)
+    # Every write to a task queued here goes through this process, which
+    # invalidates the row, so its cached row stays current.
+    with task_cancel_lock:
+        owned = key in task_cancel_events
+    with task_cache_lock:
+        entry = task_cache.get(key)
+        if entry is not None:
+            row, stored_at = entry
+            if (
+                row[0] == "completed"
+                or owned
+                or time.monotonic() - stored_at <= STATUS_CACHE_SECONDS
+            ):
+                task_cache_stats["hits"] += 1
+                return row
+        task_cache_stats["misses"] += 1
+    return None
+
+
+def cache_task(client_id, sha256, task_type, row, epoch):
+    """Cache a row read at epoch, unless a writer has invalidated since"""
+    with task_cache_lock:
+        if epoch == task_cache_epoch:
+            task_cache[(client_id, sha256, task_type)] = (
+                row,
+                time.monotonic(),
+            )
+
+
+def invalidate_task(client_id, sha256=None, task_type=None):
+    global task_cache_epoch
+    with task_cache_lock:
+        task_cache_epoch += 1
+        if sha256 is not None and task_type is not None:
+            task_cache.pop((client_id, sha256, task_type), None)
+            return
+        for key in list(task_cache.keys()):
+            if key[0] == client_id and sha256 in (None, key[1]):
+                task_cache.pop(key, None)
+
+
+def touch_task(client_id, sha256, task_type):
+    """Record an access; last_accessed is written by flush_access_times"""
+    with access_lock:
+        pending_access[(client_id, sha256, task_type)] = time.time()
+
+
+def flush_access_times():
+    with access_lock:
+        if not pending_access:
+            return
+        pending = dict(pending_access)
+        pending_access.clear()
+    rows = [
+        (
+            datetime.fromtimestamp(accessed, timezone.utc).strftime(
+                "%Y-%m-%d %H:%M:%S"
+            ),
+        )
+        + key
+        for key, accessed in pending.items()
+    ]
+    try:
+        with sqlite3.connect("tasks.db") as conn:
+            conn.executemany(
+                """
+                UPDATE tasks
+                SET last_accessed = ?
+                WHERE client_id = ?
+                AND sha256 = ?
+                AND type = ?
+                """,
+                rows,
+            )
+            conn.commit()
+    except Exception as e:
+        app.logger.error(f"Failed to flush access times: {str(e)}")
+        with access_lock:
+            for key, accessed in pending.items():
+                pending_access.setdefault(key, accessed)
+
+
+def access_flusher():
+    while True:
+        time.sleep(ACCESS_FLUSH_SECONDS)
+        flush_access_times()
+
+
 def write_error_to_cache(task, error_code):
     try:
         with sqlite3.connect("tasks.db") as conn:
@@ -374,6 +1221,8 @@ def write_error_to_cache(task, error_code):
                 UPDATE tasks
                 SET status='error',
                 error_detail=?,
+                stage=NULL,
+                partial=NULL,
                 last_accessed=?
                 WHERE client_id=?
                 AND sha256=?
@@ -390,12 +1239,17 @@ def write_error_to_cache(task, error_code):
             conn.commit()
     except Exception as e:
         app.logger.error(f"Failed to write error to cache: {str(e)}")
+    invalidate_task(task["client_id"], task["sha256"], task["type"])
 
 
 def write_result_to_cache(task, raw_result):
     try:
         aes_key = task["aes_key"]
-        encrypted_result = aes_encrypt(raw_result, aes_key)
+        encrypted_result = aes_encrypt(
+            raw_result, aes_key, task.get("cipher", "cbc")
+        )
+        digest = hashlib.sha256(encrypted_result.encode()).hexdigest()
+        result_version = digest[:16]
         with sqlite3.connect("tasks.db") as conn:
             c = conn.cursor()
             c.execute(
@@ -403,6 +1257,9 @@ def write_result_to_cache(task, raw_result):
                 UPDATE tasks
                 SET status='completed',
                 result=?,
+                result_version=?,
+                stage=NULL,
+                partial=NULL,
                 last_accessed=?
                 WHERE client_id=?
                 AND sha256=?
@@ -410,6 +1267,7 @@ def write_result_to_cache(task, raw_result):
                 """,
                 (
                     encrypted_result,
+                    result_version,
                     get_current_utc_time(),
                     task["client_id"],
                     task["sha256"],
@@ -419,43 +1277,295 @@ def write_result_to_cache(task, raw_result):
             conn.commit()
     except Exception as e:
         app.logger.error(f"Failed to write result to cache: {str(e)}")
+    invalidate_task(task["client_id"], task["sha256"], task["type"])
+
+
+def write_partial_to_cache(task, stage, partial=None, eta_at=None):
+    """Record the running stage, an encrypted partial result and the ETA"""
+    try:
+        encrypted_partial = None
+        if partial is not None:
+            encrypted_partial = aes_encrypt(
+                json.dumps(partial), task["aes_key"], task.get("cipher", "cbc")
+            )
+        with sqlite3.connect("tasks.db") as conn:
+            c = conn.cursor()
+            c.execute(
+                """
+                UPDATE tasks
+                SET stage=?,
+                partial=?,
+                eta_at=COALESCE(?, eta_at)
+                WHERE client_id=?
+                AND sha256=?
+                AND type=?
+                AND status='processing'
+                """,
+                (
+                    stage,
+                    encrypted_partial,
+                    eta_at,
+                    task["client_id"],
+                    task["sha256"],
+                    task["type"],
+                ),
+            )
+            conn.commit()
+    except Exception as e:
+        app.logger.error(f"Failed to write partial result: {str(e)}")
+    invalidate_task(task["client_id"], task["sha256"], task["type"])
+
+
+def partial_output_writer(task, partial):
+    """Return an on_delta callback that publishes parsed LLM fields"""
+    state = {"last_write": 0.0, "fields": None}
+
+    def on_delta(text):
+        now = time.monotonic()
+        if now - state["last_write"] < PARTIAL_UPDATE_INTERVAL:
+            return
+        fields = parse_partial_output(text)
+        if not fields or fields == state["fields"]:
+            return
+        state["last_write"] = now
+        state["fields"] = fields
+        write_partial_to_cache(task, "llm", {**partial, "fields": fields})
+
+    return on_delta
+
+
+def stage_estimate(name, default):
+    estimate = stage_stats.percentile(name, 0.5)
+    return DEFAULT_STAGE_SECONDS[default] if estimate is None else estimate
+
+
+def predict_seconds(task_type, pages, stage=None):
+    """Median time a task needs from the start of stage (None: from start)"""
+    llm = stage_estimate(f"llm:{task_type}", "llm")
+    if task_type == "fill" or stage == "llm":
+        return llm
+    return stage_estimate("ocr_page", "ocr_page") * pages + llm
+
+
+def queue_wait_seconds():
+    """Expected wait for a free worker, from the work queued and running"""
+    now = time.monotonic()
+    with task_cancel_lock:
+        work = list(task_work.values())
+    if len(work) < MAX_REQUEST_CONCURRENCY:
+        return 0.0
+    left = sum(
+        estimate if started is None else max(0.0, estimate - now + started)
+        for estimate, started in work
+    )
+    return left / MAX_REQUEST_CONCURRENCY
+
+
+def task_key(task):
+    return task["client_id"], task["sha256"], task["type"]
+
+
+def enqueue_task(task, deadline=None, estimate=0.0):
+    """Queue a task with a cancel event that /clear can set"""
+    task["deadline"] = deadline
+    task["cancel_event"] = threading.Event()
+    with task_cancel_lock:
+        task_cancel_events[task_key(task)] = task["cancel_event"]
+        task["work"] = task_work[task_key(task)] = [estimate, None]
+    task_queue.put(task)
+
+
+def start_task(task):
+    with task_cancel_lock:
+        task["work"][1] = time.monotonic()
+
+
+def release_task(task):
+    with task_cancel_lock:
+        key = task_key(task)
+        if task_cancel_events.get(key) is task.get("cancel_event"):
+            del task_cancel_events[key]
+        if task_work.get(key) is task.get("work"):
+            del task_work[key]
+
+
+def cancel_tasks(client_id, sha256=None, task_type=None):
+    """Set the cancel events of this process's matching tasks"""
+    with task_cancel_lock:
+        keys = [
+            key
+            for key in task_cancel_events
+            if key[0] == client_id
+            and (sha256 is None or key[1] == sha256)
+            and (task_type is None or key[2] == task_type)
+        ]
+        for key in keys:
+            task_cancel_events.pop(key).set()
+    if keys:
+        app.logger.info(f"Cancelled {len(keys)} tasks of {client_id}")
+
+
+def cancel_watcher():
+    """Cancel tasks whose row was deleted by /clear in another process"""
+    while True:
+        time.sleep(CANCEL_CHECK_SECONDS)
+        with task_cancel_lock:
+            keys = list(task_cancel_events)
+        if not keys:
+            continue
+        try:
+            existing = set()
+            with sqlite3.connect("tasks.db") as conn:
+                # 300 keys of 3 parameters stay under SQLite's 999 limit.
+                for i in range(0, len(keys), 300):
+                    chunk = keys[i : i + 300]
+                    rows = conn.execute(
+                        "SELECT client_id, sha256, type FROM tasks "
+                        "WHERE (client_id, sha256, type) IN (VALUES "
+                        + ", ".join(["(?, ?, ?)"] * len(chunk))
+                        + ")",
+                        [part for key in chunk for part in key],
+                    ).fetchall()
+                    existing.update(rows)
+        except Exception as e:
+            app.logger.error(f"Cancel check failed: {str(e)}")
+            continue
+        with task_cancel_lock:
+            for key in keys:
+                if key not in existing and key in task_cancel_events:
+                    task_cancel_events.pop(key).set()
+
+
+def task_abort_code(task):
+    """TASK_CANCELLED or DEADLINE_EXCEEDED if the task should not go on"""
+    cancel_event = task.get("cancel_event")
+    if cancel_event is not None and cancel_event.is_set():
+        return "TASK_CANCELLED"
+    deadline = task.get("deadline")
+    if deadline is not None and time.monotonic() >= deadline:
+        return "DEADLINE_EXCEEDED"
+    return None
+
+
+def parse_deadline(data):
+    """Deadline of the optional deadline_ms field, on the monotonic clock"""
+    if "deadline_ms" not in data:
+        return None
+    deadline_ms = data["deadline_ms"]
+    if (
+        isinstance(deadline_ms, bool)
+        or not isinstance(deadline_ms, (int, float))
+        or deadline_ms <= 0
+    ):
+        raise ValueError("INVALID_PARAMETER")
+    return time.monotonic() + deadline_ms / 1000
+
+
+def abort_task(task, code):
+    """Drop a cancelled task, or fail a task that missed its deadline"""
+    if code == "DEADLINE_EXCEEDED":
+        app.logger.warning("Task dropped after its deadline")
+        write_error_to_cache(task, code)
+        stat = "deadline_exceeded"
+    else:
+        # The row is gone; drop checkpoints written since /clear.
+        app.logger.info("Task dropped after /clear")
+        delete_checkpoints(task["client_id"], task["sha256"], task["type"])
+        stat = "cancelled"
+    with task_cancel_lock:
+        task_stats[stat] += 1
 
 
 def process_task(task):
+    for attempt in range(1, TASK_MAX_ATTEMPTS + 1):
+        error_code = run_task_stages(task)
+        if error_code is None:
+            delete_checkpoints(task["client_id"], task["sha256"], task["type"])
+            return
+        if error_code in ["TASK_CANCELLED", "DEADLINE_EXCEEDED"]:
+            abort_task(task, error_code)
+            return
+        if error_code not in RETRYABLE_ERRORS or attempt == TASK_MAX_ATTEMPTS:
+            write_error_to_cache(task, error_code)
+            return
+        app.logger.warning(
+            f"Task stage failed with {error_code}, resuming "
+            f"(attempt {attempt + 1}/{TASK_MAX_ATTEMPTS})"
+        )
+        time.sleep(TASK_RETRY_BACKOFF_SECONDS * attempt)
+
+
+def run_task_stages(task):
+    """Run the task from its last checkpointed stage.
+
+    Returns None on success or the error code of the failed stage.
+    """
     try:
-        if task["type"] == "fill":
+        checkpoints = read_checkpoints(task)
+        content = task["content"]
+        prompt = checkpoints.get("prompt")
+        partial = {}
+        if prompt is None and content is None:
+            return "PROCESSING_ERROR"
+
+        prefilled = json.loads(checkpoints.get("prefill", "{}"))
+
+        abort_code = task_abort_code(task)
+        if abort_code:
+            return abort_code
+        if prompt is not None:
+            pass
+        elif task["type"] == "fill":
             try:
-                prompt = construct_prompt_fill(
-                    task["content"]["to_process"], task["content"]["file_lib"]
-                )
+                prefilled, prompt = prepare_fill(task, content)
+                if prompt is None:
+                    write_result_to_cache(task, json.dumps(prefilled))
+                    return None
             except ValueError as e:
-                write_error_to_cache(task, str(e))
-                return
+                return str(e)
             except Exception as e:
                 app.logger.error(
                     f"Unexpected error in fill prompt construction: {str(e)}"
                 )
-                write_error_to_cache(task, "FILL_PROMPT_CONSTRUCTION_FAILED")
-                return
+                return "FILL_PROMPT_CONSTRUCTION_FAILED"
+            write_checkpoint(task, "prompt", prompt)
         else:
+            done_pages = {
+                int(stage.split(":", 1)[1]): text
+                for stage, text in checkpoints.items()
+                if stage.startswith("ocr:")
+            }
+            pages = len(content["to_process"])
+            write_partial_to_cache(
+                task,
+                "ocr",
+                eta_at=time.time()
+                + predict_seconds(task["type"], pages - len(done_pages)),
+            )
+            ocr_start = time.monotonic()
             try:
-                text = images_to_text(task["content"]["to_process"])
+                text = images_to_text(
+                    content["to_process"],
+                    done_pages,
+                    lambda i, page_text: write_checkpoint(
+                        task, f"ocr:{i}", page_text
+                    ),
+                    task.get("cancel_event"),
+                )
             except Exception:
-                write_error_to_cache(task, "OCR_FAILURE")
-                return
+                return task_abort_code(task) or "OCR_FAILURE"
+            if pages and not done_pages:
+                stage_stats.record_success(
+                    "ocr_page", (time.monotonic() - ocr_start) / pages
+                )
 
             try:
                 if task["type"] == "doc":
-                    prompt = construct_prompt_doc(
-                        text, task["content"]["file_lib"]
-                    )
+                    prompt = construct_prompt_doc(text, content["file_lib"])
                 else:
-                    prompt = construct_prompt_form(
-                        text, task["content"]["file_lib"]
-                    )
+                    prompt = construct_prompt_form(text, content["file_lib"])
             except ValueError as e:
-                write_error_to_cache(task, str(e))
-                return
+                return str(e)
             except Exception as e:
                 error_code = (
                     "DOC_PROMPT_CONSTRUCTION_FAILED"
@@ -465,51 +1575,387 @@ def process_task(task):
                 app.logger.error(
                     f"Unexpected error in prompt construction: {str(e)}"
                 )
-                write_error_to_cache(task, error_code)
-                return
-
+                return error_code
+            write_checkpoint(task, "prompt", prompt)
+            partial["ocr_text"] = text
+
+        abort_code = task_abort_code(task)
+        if abort_code:
+            return abort_code
+        llm_output = checkpoints.get("llm_raw")
+        write_partial_to_cache(
+            task,
+            "llm",
+            partial or None,
+            eta_at=time.time()
+            + (0.0 if llm_output else predict_seconds(task["type"], 0, "llm")),
+        )
+        llm_start = time.monotonic()
         try:
-            result = call_llm(prompt, task["type"])
+            pages = (
+                0
+                if task["type"] == "fill" or content is None
+                else len(content["to_process"])
+            )
+            result = call_llm(
+                prompt,
+                task["type"],
+                pages,
+                output=llm_output,
+                on_output=lambda output: write_checkpoint(
+                    task, "llm_raw", output
+                ),
+                on_delta=(
+                    partial_output_writer(task, partial)
+                    if task["type"] != "fill"
+                    else None
+                ),
+                cancel_event=task.get("cancel_event"),
+            )
+        except LLMCancelled:
+            return "TASK_CANCELLED"
+        except ValueError:
+            # The completion itself was unusable; do not resume from it.
+            delete_checkpoints(
+                task["client_id"], task["sha256"], task["type"], "llm_raw"
+            )
+            return "LLM_FAILURE"
         except Exception:
-            write_error_to_cache(task, "LLM_FAILURE")
-            return
+            return "LLM_FAILURE"
 
-        write_result_to_cache(task, result)
+        if llm_output is None:
+            stage_stats.record_success(
+                f"llm:{task['type']}", time.monotonic() - llm_start
+            )
+        if task_abort_code(task) == "TASK_CANCELLED":
+            return "TASK_CANCELLED"
+        write_result_to_cache(task, merge_prefill(result, prefilled))
+        return None
     except Exception as e:
         app.logger.error(f"Unhandled processing error: {str(e)}")
-        write_error_to_cache(task, "PROCESSING_ERROR")
+        return "PROCESSING_ERROR"
 
 
 def worker_process():
     while True:
         cleanup_old_entries()
-        if not task_queue.empty():
-            task = task_queue.get()
+        try:
+            task = task_queue.get(timeout=MAX_REQUEST_CONCURRENCY)
+        except Empty:
+            continue
+        abort_code = task_abort_code(task)
+        if abort_code:
+            abort_task(task, abort_code)
+            release_task(task)
+            continue
+        start_task(task)
+        label = f"{task['type']}-{task['sha256'][:12]}"
+        with slow_task_profiler.track(label) as tracked:
             process_task(task)
-        else:
-            time.sleep(MAX_REQUEST_CONCURRENCY)
+        release_task(task)
+        if tracked.profile:
+            app.logger.warning(f"Slow task profiled: {tracked.profile}")
+
+
+# Lifecycle. Importing this module only defines things. preload() does the
+# fork-safe setup that workers can share when the server imports the app
+# before forking; start_runtime() starts the per-process clients and
+# threads, which do not survive a fork.
+
+
+def build_llm_router():
+    if LLM_PROVIDER == "fake":
+        provider = FakeProvider()
+    else:
+        provider = ZhipuProvider(api_key=LLM_API_KEY)
+    return LLMRouter(
+        provider,
+        routes=LLM_ROUTES,
+        default_model=LLM_MODEL,
+        fallback_models=LLM_FALLBACK_MODELS,
+        concurrency=(LLM_CONCURRENCY,) + tuple(LLM_CONCURRENCY_BOUNDS),
+        # A primary and a hedge for every task worker.
+        max_workers=MAX_REQUEST_CONCURRENCY * 2,
+    )
+
 
+def preload():
+    """Create the DB schema, parse the RSA key and import the LLM SDK"""
+    global file_lib_store, session_aead
+    init_db()
+    get_rsa_private_key()
+    if file_lib_store is None:
+        file_lib_store = FileLibStore(
+            "tasks.db", server_key(b"docusnap file_lib store")
+        )
+    if session_aead is None:
+        session_aead = AESGCM(server_key(b"docusnap session store"))
+    if LLM_PROVIDER != "fake":
+        import zhipuai  # noqa: F401
+
+
+def start_runtime(workers=True):
+    """Start the LLM client, task workers and OCR probes of this process.
+
+    Cheap once started; runs again in a forked child, where the parent's
+    threads and connections do not exist. workers=False only creates the
+    clients, for command-line tools.
+    """
+    global llm_router, runtime_pid
+    if runtime_pid == os.getpid():
+        return
+    with runtime_lock:
+        if runtime_pid == os.getpid():
+            return
+        preload()
+        llm_router = build_llm_router()
+        if workers:
+            for _ in range(MAX_REQUEST_CONCURRENCY):
+                threading.Thread(target=worker_process, daemon=True).start()
+            ocr_pool.start_probes()
+            slow_task_profiler.start()
+            threading.Thread(target=access_flusher, daemon=True).start()
+            threading.Thread(target=cancel_watcher, daemon=True).start()
+            atexit.register(flush_access_times)
+        runtime_pid = os.getpid()
+
+
+def create_app():
+    """WSGI entry point: `gunicorn "app:create_app()"`.
+
+    With --preload this runs once in the master, so the key parsing and
+    imports are shared; workers start their runtime on the first request,
+    or earlier through the hook in gunicorn.conf.py.
+    """
+    preload()
+    return app
 
-for _ in range(MAX_REQUEST_CONCURRENCY):
-    threading.Thread(target=worker_process, daemon=True).start()
+
+@app.before_request
+def ensure_runtime():
+    start_runtime()
 
 
 def construct_error_result(error_code):
-    return (jsonify({"status": "error", "error_detail": error_code}), 400)
+    return {"status": "error", "error_detail": error_code}, 400
+
+
+def result_etag(result_version):
+    return f'"{result_version}"'
+
+
+def parse_fields(data):
+    """The optional fields list of a request, or None for all fields"""
+    fields = data.get("fields")
+    if fields is None:
+        return None
+    if not isinstance(fields, list) or not all(
+        isinstance(field, str) for field in fields
+    ):
+        raise ValueError("INVALID_PARAMETER")
+    return fields
+
+
+def project_fields(rv, fields):
+    """Keep only the requested response fields; status is always kept"""
+    if not fields:
+        return rv
+    body = {
+        key: value
+        for key, value in rv[0].items()
+        if key == "status" or key in fields
+    }
+    return (body,) + tuple(rv[1:])
+
+
+def conditional_result(rv, if_none_match):
+    """Turn a completed result into 304 if the client already holds it"""
+    if len(rv) < 3 or not if_none_match:
+        return rv
+    etag = rv[2].get("ETag")
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    if etag and (etag in tags or "*" in tags):
+        return "", 304, {"ETag": etag}
+    return rv
+
+
+def eta_hints(eta_at):
+    """(eta_ms, Retry-After seconds) of a processing task, or None"""
+    if eta_at is None:
+        return None
+    remaining = max(0.0, eta_at - time.time())
+    retry_after = min(MAX_RETRY_AFTER_SECONDS, max(1, math.ceil(remaining)))
+    return int(remaining * 1000), retry_after
 
 
 def construct_task_result(task):
-    status, error_code, result = task
+    status, error_code, result, result_version, stage, partial, eta_at = task
     if status == "error":
         return construct_error_result(error_code)
     if status == "processing":
-        return jsonify({"status": "processing"}), 202
-    return jsonify({"status": "completed", "result": result}), 200
+        body = {"status": "processing"}
+        if stage:
+            body["stage"] = stage
+        if partial:
+            body["partial"] = partial
+        hints = eta_hints(eta_at)
+        if hints is None:
+            return body, 202
+        body["eta_ms"] = hints[0]
+        return body, 202, {"Retry-After": str(hints[1])}
+    headers = {}
+    if result_version:
+        headers["ETag"] = result_etag(result_version)
+    return {"status": "completed", "result": result}, 200, headers
+
+
+def resolve_aes_key(data, client_id):
+    """Return the AES key of a request, from key_id or the RSA-wrapped key"""
+    if "key_id" in data:
+        try:
+            aes_key_bytes = lookup_session_key(client_id, data["key_id"])
+        except sqlite3.Error as e:
+            app.logger.error(f"Session lookup failed: {str(e)}")
+            raise ValueError("DATABASE_ERROR")
+        if aes_key_bytes is None:
+            app.logger.error("Session key not found or expired")
+            raise ValueError("SESSION_NOT_FOUND")
+        return aes_key_bytes
+    try:
+        return rsa_decrypt_key(data["aes_key"])
+    except Exception as e:
+        app.logger.error(f"RSA decryption failed: {str(e)}")
+        raise ValueError("RSA_DECRYPTION_FAILED")
 
 
-@app.route("/process", methods=["POST"])
-def unified_process():
-    data = request.get_json()
+def decode_submission(data, client_id, sha256, task_type, cipher_mode):
+    """Verify and decrypt uploaded content; returns (payload, AES key)"""
+    content = data["content"]
+    try:
+        if isinstance(content, str):
+            content = content.encode()
+        computed_sha256 = hashlib.sha256(content).hexdigest()
+    except Exception as e:
+        app.logger.error(f"SHA256 verification failed: {str(e)}")
+        raise ValueError("SHA256_VERIFICATION_FAILED")
+    if computed_sha256 != sha256:
+        app.logger.error("SHA256 mismatch")
+        raise ValueError("SHA256_MISMATCH")
+
+    aes_key_bytes = resolve_aes_key(data, client_id)
+
+    pages = None
+    try:
+        if "sections" in data:
+            sections = data["sections"]
+            decrypted_content = aes_decrypt_bytes(
+                sections[0], aes_key_bytes, cipher_mode
+            )
+            pages = [
+                aes_decrypt_bytes(section, aes_key_bytes, cipher_mode)
+                for section in sections[1:]
+            ]
+        else:
+            decrypted_content = aes_decrypt(
+                data["content"], aes_key_bytes, cipher_mode
+            )
+    except Exception as e:
+        app.logger.error(f"AES decryption failed: {str(e)}")
+        raise ValueError("AES_DECRYPTION_FAILED")
+
+    try:
+        inner_payload = json.loads(decrypted_content)
+    except Exception as e:
+        app.logger.error(f"JSON parsing failed: {str(e)}")
+        raise ValueError("INVALID_JSON")
+
+    if pages is not None and task_type != "fill":
+        inner_payload["to_process"] = pages
+    if "file_lib" not in inner_payload and "file_lib_version" in inner_payload:
+        try:
+            inner_payload["file_lib"] = file_lib_store.lookup(
+                client_id, inner_payload["file_lib_version"]
+            )
+        except ValueError as e:
+            app.logger.error(f"Stored file_lib unavailable: {str(e)}")
+            raise
+        except Exception as e:
+            app.logger.error(f"Stored file_lib lookup failed: {str(e)}")
+            raise ValueError("FILE_LIB_LOOKUP_FAILED")
+    return inner_payload, aes_key_bytes
+
+
+def retry_task(
+    conn, data, client_id, sha256, task_type, cipher_mode, deadline=None
+):
+    """Re-queue a failed task, resuming from its checkpoints"""
+    try:
+        if data["has_content"]:
+            inner_payload, aes_key_bytes = decode_submission(
+                data, client_id, sha256, task_type, cipher_mode
+            )
+        else:
+            inner_payload = None
+            aes_key_bytes = resolve_aes_key(data, client_id)
+    except ValueError as e:
+        return construct_error_result(str(e))
+
+    task = {
+        "client_id": client_id,
+        "sha256": sha256,
+        "type": task_type,
+        "content": inner_payload,
+        "aes_key": aes_key_bytes,
+        "cipher": cipher_mode,
+    }
+    if inner_payload is None and "prompt" not in read_checkpoints(task):
+        app.logger.error("Retry without content and no usable checkpoint")
+        return construct_error_result("RETRY_NEEDS_CONTENT")
+
+    if inner_payload is None or task_type == "fill":
+        estimate = predict_seconds(task_type, 0, "llm")
+    else:
+        estimate = predict_seconds(task_type, len(inner_payload["to_process"]))
+    eta_at = time.time() + queue_wait_seconds() + estimate
+    current_time = get_current_utc_time()
+    try:
+        conn.execute(
+            """
+            UPDATE tasks
+            SET status = 'processing',
+            error_detail = NULL,
+            stage = NULL,
+            partial = NULL,
+            created_at = ?,
+            last_accessed = ?,
+            eta_at = ?
+            WHERE client_id = ?
+            AND sha256 = ?
+            AND type = ?
+            """,
+            (
+                current_time,
+                current_time,
+                eta_at,
+                client_id,
+                sha256,
+                task_type,
+            ),
+        )
+        conn.commit()
+    except Exception as e:
+        app.logger.error(f"Database update failed: {str(e)}")
+        return construct_error_result("DATABASE_ERROR")
+    invalidate_task(client_id, sha256, task_type)
+
+    enqueue_task(task, deadline, estimate)
+    body, _, headers = construct_task_result(
+        ("processing", None, None, None, None, None, eta_at)
+    )
+    return body, 202, headers
+
+
+def handle_process(data):
     required = ["client_id", "type", "SHA256", "has_content"]
     for field in required:
         if field not in data:
@@ -529,12 +1975,39 @@ def unified_process():
         app.logger.error("Content required but missing")
         return construct_error_result("MISSING_CONTENT")
 
+    cipher_mode = data.get("cipher", "cbc")
+    if cipher_mode not in ["cbc", "gcm"]:
+        app.logger.error(f"Invalid cipher: {cipher_mode}")
+        return construct_error_result("INVALID_CIPHER")
+
+    try:
+        deadline = parse_deadline(data)
+    except ValueError as e:
+        app.logger.error("Invalid deadline_ms")
+        return construct_error_result(str(e))
+
+    try:
+        fields = parse_fields(data)
+    except ValueError as e:
+        app.logger.error("Invalid fields")
+        return construct_error_result(str(e))
+    result_column = "result" if not fields or "result" in fields else "NULL"
+    partial_column = "partial" if not fields or "partial" in fields else "NULL"
+
+    if not data.get("retry"):
+        task = cached_task(client_id, sha256, task_type)
+        if task:
+            touch_task(client_id, sha256, task_type)
+            return project_fields(construct_task_result(task), fields)
+
     current_time = get_current_utc_time()
+    epoch = task_cache_epoch
     with sqlite3.connect("tasks.db") as conn:
         c = conn.cursor()
         c.execute(
-            """
-            SELECT status, error_detail, result
+            f"""
+            SELECT status, error_detail, {result_column}, result_version,
+            stage, {partial_column}, eta_at
             FROM tasks
             WHERE client_id = ?
             AND sha256 = ?
@@ -543,53 +2016,30 @@ def unified_process():
             (client_id, sha256, task_type),
         )
         task = c.fetchone()
-        if task:
-            c.execute(
-                """
-                UPDATE tasks
-                SET last_accessed = ?
-                WHERE client_id = ?
-                AND sha256 = ?
-                AND type = ?
-                """,
-                (current_time, client_id, sha256, task_type),
+        if task and task[0] == "error" and data.get("retry"):
+            return retry_task(
+                conn, data, client_id, sha256, task_type, cipher_mode, deadline
             )
-            conn.commit()
-            return construct_task_result(task)
+        if task:
+            if result_column == "result" and partial_column == "partial":
+                cache_task(client_id, sha256, task_type, task, epoch)
+            touch_task(client_id, sha256, task_type)
+            return project_fields(construct_task_result(task), fields)
 
         if not has_content:
             app.logger.error("Task not found and no content provided")
             return construct_error_result("TASK_NOT_FOUND")
 
         try:
-            computed_sha256 = hashlib.sha256(
-                data["content"].encode()
-            ).hexdigest()
-            if computed_sha256 != sha256:
-                app.logger.error("SHA256 mismatch")
-                return construct_error_result("SHA256_MISMATCH")
-        except Exception as e:
-            app.logger.error(f"SHA256 verification failed: {str(e)}")
-            return construct_error_result("SHA256_VERIFICATION_FAILED")
-
-        try:
-            aes_key_bytes = rsa_decrypt_key(data["aes_key"])
-        except Exception as e:
-            app.logger.error(f"RSA decryption failed: {str(e)}")
-            return construct_error_result("RSA_DECRYPTION_FAILED")
-
-        try:
-            decrypted_content = aes_decrypt(data["content"], aes_key_bytes)
-        except Exception as e:
-            app.logger.error(f"AES decryption failed: {str(e)}")
-            return construct_error_result("AES_DECRYPTION_FAILED")
-
-        try:
-            inner_payload = json.loads(decrypted_content)
-        except Exception as e:
-            app.logger.error(f"JSON parsing failed: {str(e)}")
-            return construct_error_result("INVALID_JSON")
+            inner_payload, aes_key_bytes = decode_submission(
+                data, client_id, sha256, task_type, cipher_mode
+            )
+        except ValueError as e:
+            return construct_error_result(str(e))
 
+        pages = 0 if task_type == "fill" else len(inner_payload["to_process"])
+        estimate = predict_seconds(task_type, pages)
+        eta_at = time.time() + queue_wait_seconds() + estimate
         try:
             c.execute(
                 """
@@ -599,8 +2049,9 @@ def unified_process():
                     type,
                     status,
                     created_at,
-                    last_accessed
-                ) VALUES (?, ?, ?, ?, ?, ?)
+                    last_accessed,
+                    eta_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?)
                 """,
                 (
                     client_id,
@@ -609,6 +2060,7 @@ def unified_process():
                     "processing",
                     current_time,
                     current_time,
+                    eta_at,
                 ),
             )
             conn.commit()
@@ -616,23 +2068,262 @@ def unified_process():
             app.logger.error(f"Database insertion failed: {str(e)}")
             return construct_error_result("DATABASE_ERROR")
 
-        task_queue.put(
+        enqueue_task(
             {
                 "client_id": client_id,
                 "sha256": sha256,
                 "type": task_type,
                 "content": inner_payload,
                 "aes_key": aes_key_bytes,
-            }
+                "cipher": cipher_mode,
+            },
+            deadline,
+            estimate,
         )
-        return jsonify({"status": "processing"}), 202
+        body, _, headers = construct_task_result(
+            ("processing", None, None, None, None, None, eta_at)
+        )
+        return body, 202, headers
 
 
-@app.route("/clear", methods=["POST"])
-def clear_cache():
-    data = request.get_json()
+def construct_batch_item(sha256, task_type, task, known_version, fields):
+    if task is None:
+        status, error_code, result, result_version, eta_at = (
+            "error",
+            "TASK_NOT_FOUND",
+            None,
+            None,
+            None,
+        )
+    else:
+        status, error_code, result, result_version, eta_at = task
+    item = {"SHA256": sha256, "type": task_type, "status": status}
+    if status == "error":
+        item["error_detail"] = error_code
+    elif status == "processing" and eta_at is not None:
+        item["eta_ms"] = eta_hints(eta_at)[0]
+    elif status == "completed":
+        item["version"] = result_version
+        if result_version and result_version == known_version:
+            item["not_modified"] = True
+        elif not fields or "result" in fields:
+            item["result"] = result
+    return item
+
+
+def handle_envelope(raw):
+    try:
+        data = parse_envelope(raw)
+    except ValueError as e:
+        app.logger.error(f"Envelope parsing failed: {str(e)}")
+        return construct_error_result(str(e))
+    return handle_process(data)
+
+
+def handle_batch(data):
+    if "client_id" not in data or "tasks" not in data:
+        app.logger.error("Missing required field in batch request")
+        return construct_error_result("MISSING_REQUIRED_FIELD")
+
+    client_id = data["client_id"]
+    tasks = data["tasks"]
+    try:
+        offset = int(data.get("offset", 0))
+        limit = int(data.get("limit", MAX_BATCH_SIZE))
+        max_bytes = int(data.get("max_bytes", MAX_BATCH_RESPONSE_BYTES))
+    except (TypeError, ValueError):
+        app.logger.error("Invalid batch pagination parameters")
+        return construct_error_result("INVALID_BATCH_REQUEST")
+    if (
+        not isinstance(tasks, list)
+        or offset < 0
+        or limit <= 0
+        or max_bytes <= 0
+    ):
+        app.logger.error("Invalid batch request")
+        return construct_error_result("INVALID_BATCH_REQUEST")
+
+    limit = min(limit, MAX_BATCH_SIZE)
+    max_bytes = min(max_bytes, MAX_BATCH_RESPONSE_BYTES)
+    page = tasks[offset : offset + limit]
+
+    try:
+        fields = parse_fields(data)
+    except ValueError as e:
+        app.logger.error("Invalid fields")
+        return construct_error_result(str(e))
+    result_column = "result" if not fields or "result" in fields else "NULL"
+
+    keys = []
+    for item in page:
+        if (
+            not isinstance(item, dict)
+            or "SHA256" not in item
+            or "type" not in item
+        ):
+            app.logger.error("Malformed batch item")
+            return construct_error_result("MISSING_REQUIRED_FIELD")
+        version = item.get("version")
+        if (
+            not isinstance(item["SHA256"], str)
+            or not isinstance(item["type"], str)
+            or not isinstance(version, (str, type(None)))
+        ):
+            app.logger.error("Invalid batch item")
+            return construct_error_result("INVALID_BATCH_REQUEST")
+        keys.append((item["SHA256"], item["type"], version))
+
+    rows = {}
+    sha_list = list({sha256 for sha256, _, _ in keys})
+    with sqlite3.connect("tasks.db") as conn:
+        c = conn.cursor()
+        if sha_list:
+            placeholders = ",".join("?" * len(sha_list))
+            c.execute(
+                f"""
+                SELECT sha256, type, status, error_detail, {result_column},
+                result_version, eta_at
+                FROM tasks
+                WHERE client_id = ?
+                AND sha256 IN ({placeholders})
+                """,
+                [client_id] + sha_list,
+            )
+            for row in c:
+                rows[(row[0], row[1])] = row[2:]
+
+        results = []
+        size = 0
+        for sha256, task_type, known_version in keys:
+            if task_type not in ["doc", "form", "fill"]:
+                item = {
+                    "SHA256": sha256,
+                    "type": task_type,
+                    "status": "error",
+                    "error_detail": "INVALID_TYPE",
+                }
+            else:
+                item = construct_batch_item(
+                    sha256,
+                    task_type,
+                    rows.get((sha256, task_type)),
+                    known_version,
+                    fields,
+                )
+            size += len(json.dumps(item))
+            if results and size > max_bytes:
+                break
+            results.append(item)
+            if (sha256, task_type) in rows:
+                touch_task(client_id, sha256, task_type)
+
+    next_offset = offset + len(results)
+    if next_offset >= len(tasks):
+        next_offset = None
+    return (
+        {"status": "ok", "results": results, "next_offset": next_offset},
+        200,
+    )
+
+
+def handle_session(data):
+    for field in ["client_id", "aes_key"]:
+        if field not in data:
+            app.logger.error(f"Missing required field: {field}")
+            return construct_error_result("MISSING_REQUIRED_FIELD")
+
+    try:
+        aes_key_bytes = rsa_decrypt_key(data["aes_key"])
+    except Exception as e:
+        app.logger.error(f"RSA decryption failed: {str(e)}")
+        return construct_error_result("RSA_DECRYPTION_FAILED")
+
+    if len(aes_key_bytes) not in [16, 24, 32]:
+        app.logger.error("Session key has invalid length")
+        return construct_error_result("INVALID_SESSION_KEY")
+
+    try:
+        key_id = register_session_key(data["client_id"], aes_key_bytes)
+    except sqlite3.Error as e:
+        app.logger.error(f"Database error: {str(e)}")
+        return construct_error_result("DATABASE_ERROR")
+    return (
+        {
+            "status": "ok",
+            "key_id": key_id,
+            "expires_in": SESSION_TTL_SECONDS,
+        },
+        200,
+    )
+
+
+def handle_file_lib(data):
+    """Apply file_lib delta ops (or a full replace) and return the version.
+
+    Without content this only reports the stored version. Ops against an
+    outdated base_version are refused with 409 and the current version.
+    """
     if "client_id" not in data:
-        return jsonify({"error": "Missing client_id"}), 400
+        app.logger.error("Missing required field: client_id")
+        return construct_error_result("MISSING_REQUIRED_FIELD")
+    client_id = data["client_id"]
+
+    try:
+        if "content" not in data:
+            version = file_lib_store.current_version(client_id)
+            return {"status": "ok", "version": version}, 200
+    except Exception as e:
+        app.logger.error(f"Database query failed: {str(e)}")
+        return construct_error_result("DATABASE_ERROR")
+
+    cipher_mode = data.get("cipher", "cbc")
+    if cipher_mode not in ["cbc", "gcm"]:
+        app.logger.error(f"Invalid cipher: {cipher_mode}")
+        return construct_error_result("INVALID_CIPHER")
+    try:
+        aes_key_bytes = resolve_aes_key(data, client_id)
+    except ValueError as e:
+        return construct_error_result(str(e))
+    try:
+        decrypted_content = aes_decrypt(
+            data["content"], aes_key_bytes, cipher_mode
+        )
+    except Exception as e:
+        app.logger.error(f"AES decryption failed: {str(e)}")
+        return construct_error_result("AES_DECRYPTION_FAILED")
+    try:
+        update = json.loads(decrypted_content)
+        if not isinstance(update, dict):
+            raise ValueError("file_lib update is not an object")
+    except Exception as e:
+        app.logger.error(f"JSON parsing failed: {str(e)}")
+        return construct_error_result("INVALID_JSON")
+
+    try:
+        version = file_lib_store.update(
+            client_id,
+            data.get("base_version", 0),
+            ops=update.get("ops"),
+            replace=update.get("replace"),
+        )
+    except ValueError as e:
+        if str(e) != "FILE_LIB_VERSION_CONFLICT":
+            return construct_error_result(str(e))
+        body = {
+            "status": "error",
+            "error_detail": str(e),
+            "version": file_lib_store.current_version(client_id),
+        }
+        return body, 409
+    except Exception as e:
+        app.logger.error(f"file_lib update failed: {str(e)}")
+        return construct_error_result("DATABASE_ERROR")
+    return {"status": "ok", "version": version}, 200
+
+
+def handle_clear(data):
+    if "client_id" not in data:
+        return {"error": "Missing client_id"}, 400
     client_id = data["client_id"]
     sha256 = data.get("SHA256")
     task_type = data.get("type")
@@ -649,6 +2340,15 @@ def clear_cache():
                     """,
                     (client_id, sha256, task_type),
                 )
+                c.execute(
+                    """
+                    DELETE FROM checkpoints
+                    WHERE client_id = ?
+                      AND sha256 = ?
+                      AND type = ?
+                    """,
+                    (client_id, sha256, task_type),
+                )
             else:
                 c.execute(
                     """
@@ -657,16 +2357,167 @@ def clear_cache():
                     """,
                     (client_id,),
                 )
+                c.execute(
+                    """
+                    DELETE FROM checkpoints
+                    WHERE client_id = ?
+                    """,
+                    (client_id,),
+                )
             conn.commit()
-            return jsonify({"status": "ok"}), 200
+            invalidate_task(client_id, sha256, task_type)
+            if sha256 and task_type:
+                cancel_tasks(client_id, sha256, task_type)
+            else:
+                cancel_tasks(client_id)
+            return {"status": "ok"}, 200
         except Exception as e:
             app.logger.error(f"Cache clear failed: {str(e)}")
-            return jsonify({"error": "CACHE_CLEAR_FAILED"}), 500
+            return {"error": "CACHE_CLEAR_FAILED"}, 500
+
+
+def handle_check_status():
+    return {"server_status": "ok"}, 200
+
+
+def handle_metrics(authorization):
+    error = check_admin(authorization)
+    if error:
+        return error
+    return {
+        "ocr_endpoints": ocr_pool.snapshot(),
+        "concurrency": {
+            "ocr": ocr_limiter.snapshot(),
+            "llm": {
+                model: limiter.snapshot()
+                for model, limiter in list(llm_router.limiters.items())
+            },
+        },
+        "llm_latency": llm_router.stats.snapshot(),
+        "queue_length": task_queue.qsize(),
+        "task_cache": {
+            "size": len(task_cache),
+            **task_cache_stats,
+            "pending_access_updates": len(pending_access),
+        },
+        "pages": dict(page_stats),
+        "tasks": dict(task_stats),
+        "stage_latency": stage_stats.snapshot(),
+    }, 200
+
+
+def check_admin(authorization):
+    """Return an error response unless the request carries ADMIN_TOKEN"""
+    if not ADMIN_TOKEN:
+        return {"status": "error", "error_detail": "ADMIN_DISABLED"}, 404
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(
+        token.strip().encode(), ADMIN_TOKEN.encode()
+    ):
+        app.logger.warning("Rejected admin request")
+        return {"status": "error", "error_detail": "UNAUTHORIZED"}, 401
+    return None
+
+
+def handle_admin_profile(authorization, seconds, interval_ms):
+    """Sample all threads for a while; returns collapsed stacks as text"""
+    error = check_admin(authorization)
+    if error:
+        return error
+    try:
+        seconds = float(seconds or 10)
+        interval_ms = float(interval_ms or DEFAULT_PROFILE_INTERVAL_MS)
+    except ValueError:
+        return construct_error_result("INVALID_PARAMETER")
+    if (
+        not 0 < seconds <= MAX_PROFILE_SECONDS
+        or not math.isfinite(interval_ms)
+        or not 1 <= interval_ms <= seconds * 1000
+    ):
+        return construct_error_result("INVALID_PARAMETER")
+    if not profile_lock.acquire(blocking=False):
+        return {"status": "error", "error_detail": "PROFILE_IN_PROGRESS"}, 409
+    try:
+        counts = sample(seconds, interval_ms / 1000)
+    finally:
+        profile_lock.release()
+    return (
+        format_collapsed(counts),
+        200,
+        {"Content-Type": "text/plain; charset=utf-8"},
+    )
+
+
+def handle_admin_profiles(authorization, name=None):
+    """List slow-task profiles, or return one of them as text"""
+    error = check_admin(authorization)
+    if error:
+        return error
+    names = sorted(list_profiles(PROFILE_DIR), reverse=True)
+    if name is None:
+        return {"profiles": names}, 200
+    if name not in names:
+        return {"status": "error", "error_detail": "PROFILE_NOT_FOUND"}, 404
+    with open(os.path.join(PROFILE_DIR, name), "r") as f:
+        return f.read(), 200, {"Content-Type": "text/plain; charset=utf-8"}
+
+
+@app.route("/process", methods=["POST"])
+def unified_process():
+    if request.mimetype == ENVELOPE_CONTENT_TYPE:
+        rv = handle_envelope(request.get_data())
+    else:
+        rv = handle_process(request.get_json())
+    return conditional_result(rv, request.headers.get("If-None-Match"))
+
+
+@app.route("/process/batch", methods=["POST"])
+def batch_process():
+    return handle_batch(request.get_json())
+
+
+@app.route("/session", methods=["POST"])
+def create_session():
+    return handle_session(request.get_json())
+
+
+@app.route("/file_lib", methods=["POST"])
+def file_lib():
+    return handle_file_lib(request.get_json())
+
+
+@app.route("/clear", methods=["POST"])
+def clear_cache():
+    return handle_clear(request.get_json())
 
 
 @app.route("/check_status")
 def check_status():
-    return jsonify({"server_status": "ok"}), 200
+    return handle_check_status()
+
+
+@app.route("/metrics")
+def metrics():
+    return handle_metrics(request.headers.get("Authorization"))
+
+
+@app.route("/admin/profile")
+def admin_profile():
+    return handle_admin_profile(
+        request.headers.get("Authorization"),
+        request.args.get("seconds"),
+        request.args.get("interval_ms"),
+    )
+
+
+@app.route("/admin/profiles")
+def admin_profiles():
+    return handle_admin_profiles(request.headers.get("Authorization"))
+
+
+@app.route("/admin/profiles/<name>")
+def admin_profile_file(name):
+    return handle_admin_profiles(request.headers.get("Authorization"), name)
 
 
 @app.route("/")
@@ -680,4 +2531,4 @@ def index():
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1,174 @@
+"""ASGI front-end for the backend.
+
+Serves the same routes and error codes as the Flask app in `app.py`, but
+keeps client connections on an event loop instead of one thread each.
+Database access, decryption and queueing run on a bounded thread pool and
+tasks are handed to the same `task_queue` worker pipeline.
+
+    uvicorn asgi:asgi_app --host 0.0.0.0 --port 5000
+"""
+
+import asyncio
+import contextlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from starlette.templating import Jinja2Templates
+
+import app as backend
+
+HANDLER_THREADS = 32
+
+handler_executor = ThreadPoolExecutor(
+    max_workers=HANDLER_THREADS, thread_name_prefix="asgi-handler"
+)
+templates = Jinja2Templates(directory="templates")
+
+
+def to_response(rv, request):
+    body, status = rv[0], rv[1]
+    headers = dict(rv[2]) if len(rv) > 2 else {}
+    if status == 304:
+        return Response(status_code=304, headers=headers)
+    if isinstance(body, str):
+        return Response(body, status_code=status, headers=headers)
+    raw = JSONResponse(body).body
+    compressed, encoding = backend.compress_body(
+        raw, request.headers.get("accept-encoding")
+    )
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    headers["Vary"] = "Accept-Encoding"
+    return Response(
+        compressed,
+        status_code=status,
+        headers=headers,
+        media_type="application/json",
+    )
+
+
+def parse_and_handle(handler, body):
+    try:
+        data = json.loads(body)
+    except Exception as e:
+        backend.app.logger.error(f"JSON parsing failed: {str(e)}")
+        return backend.construct_error_result("INVALID_JSON")
+    return handler(data)
+
+
+async def run_handler(handler, request):
+    body = await request.body()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        handler_executor, parse_and_handle, handler, body
+    )
+
+
+async def unified_process(request):
+    content_type = request.headers.get("content-type", "")
+    if content_type.split(";")[0].strip() == backend.ENVELOPE_CONTENT_TYPE:
+        body = await request.body()
+        loop = asyncio.get_running_loop()
+        rv = await loop.run_in_executor(
+            handler_executor, backend.handle_envelope, body
+        )
+    else:
+        rv = await run_handler(backend.handle_process, request)
+    rv = backend.conditional_result(rv, request.headers.get("if-none-match"))
+    return to_response(rv, request)
+
+
+async def batch_process(request):
+    return to_response(
+        await run_handler(backend.handle_batch, request), request
+    )
+
+
+async def create_session(request):
+    return to_response(
+        await run_handler(backend.handle_session, request), request
+    )
+
+
+async def file_lib(request):
+    return to_response(
+        await run_handler(backend.handle_file_lib, request), request
+    )
+
+
+async def clear_cache(request):
+    return to_response(
+        await run_handler(backend.handle_clear, request), request
+    )
+
+
+async def check_status(request):
+    return to_response(backend.handle_check_status(), request)
+
+
+async def metrics(request):
+    return to_response(
+        backend.handle_metrics(request.headers.get("authorization")),
+        request,
+    )
+
+
+async def admin_profile(request):
+    loop = asyncio.get_running_loop()
+    rv = await loop.run_in_executor(
+        handler_executor,
+        backend.handle_admin_profile,
+        request.headers.get("authorization"),
+        request.query_params.get("seconds"),
+        request.query_params.get("interval_ms"),
+    )
+    return to_response(rv, request)
+
+
+async def admin_profiles(request):
+    return to_response(
+        backend.handle_admin_profiles(
+            request.headers.get("authorization"),
+            request.path_params.get("name"),
+        ),
+        request,
+    )
+
+
+async def index(request):
+    clean_key = backend.RSA_PUBLIC_KEY.strip().replace("\n", "\\n")
+    with open("static/mockup_file_lib.json", "r", encoding="utf-8") as f:
+        mockup_file_lib = json.load(f)
+    return templates.TemplateResponse(
+        request,
+        "ocr.html",
+        {"public_key": clean_key, "mockup_file_lib": mockup_file_lib},
+    )
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    backend.preload()
+    backend.start_runtime()
+    yield
+
+
+asgi_app = Starlette(
+    lifespan=lifespan,
+    routes=[
+        Route("/process", unified_process, methods=["POST"]),
+        Route("/process/batch", batch_process, methods=["POST"]),
+        Route("/session", create_session, methods=["POST"]),
+        Route("/file_lib", file_lib, methods=["POST"]),
+        Route("/clear", clear_cache, methods=["POST"]),
+        Route("/check_status", check_status),
+        Route("/metrics", metrics),
+        Route("/admin/profile", admin_profile),
+        Route("/admin/profiles", admin_profiles),
+        Route("/admin/profiles/{name}", admin_profiles),
+        Route("/", index),
+    ],
+)
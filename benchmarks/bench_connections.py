@@ -0,0 +1,161 @@
+"""Idle-connection capacity and tail latency of a running backend.
+
+Opens many idle or slow client connections, then measures the latency of
+fresh requests while those connections stay open. Start the server first,
+for example:
+
+    gunicorn -w 4 --threads 20 app:app -b 127.0.0.1:5000
+    uvicorn asgi:asgi_app --host 127.0.0.1 --port 5000
+
+then run
+
+    python benchmarks/bench_connections.py --idle 10000 --requests 2000
+
+Raise `ulimit -n` on both sides before opening tens of thousands of
+connections.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+SLOW_REQUEST_HEAD = (
+    "POST /process HTTP/1.1\r\n"
+    "Host: bench\r\n"
+    "Content-Type: application/json\r\n"
+)
+
+
+async def open_idle(host, port, mode, holders):
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError:
+        return False
+    if mode == "slow":
+        # A client on a bad mobile link: headers started, never finished.
+        writer.write(SLOW_REQUEST_HEAD.encode())
+    else:
+        writer.write(
+            b"GET /check_status HTTP/1.1\r\nHost: bench\r\n"
+            b"Connection: keep-alive\r\n\r\n"
+        )
+    await writer.drain()
+    holders.append(writer)
+    return True
+
+
+async def timed_request(host, port, path, body, timeout):
+    if body is None:
+        raw = (
+            f"GET {path} HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n"
+        )
+    else:
+        raw = (
+            f"POST {path} HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n{body}"
+        )
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), timeout
+        )
+        writer.write(raw.encode())
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        await asyncio.wait_for(reader.read(), timeout)
+        writer.close()
+    except (OSError, asyncio.TimeoutError):
+        return None
+    if not status_line.startswith(b"HTTP/1.1"):
+        return None
+    return time.perf_counter() - start
+
+
+def rss_kib(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def run(args):
+    holders = []
+    opened = 0
+    for start in range(0, args.idle, 500):
+        batch = range(start, min(args.idle, start + 500))
+        results = await asyncio.gather(
+            *[
+                open_idle(args.host, args.port, args.mode, holders)
+                for _ in batch
+            ]
+        )
+        opened += sum(results)
+
+    body = None
+    if args.path == "/process":
+        body = json.dumps(
+            {
+                "client_id": "bench",
+                "type": "doc",
+                "SHA256": "0" * 64,
+                "has_content": False,
+            }
+        )
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one():
+        async with semaphore:
+            return await timed_request(
+                args.host, args.port, args.path, body, args.timeout
+            )
+
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*[one() for _ in range(args.requests)])
+    elapsed = time.perf_counter() - started
+    ok = [latency for latency in latencies if latency is not None]
+
+    report = {
+        "idle_requested": args.idle,
+        "idle_open": opened,
+        "requests": args.requests,
+        "failed": args.requests - len(ok),
+        "throughput_rps": round(len(ok) / elapsed, 1),
+    }
+    if ok:
+        report["p50_ms"] = round(percentile(ok, 50) * 1000, 2)
+        report["p99_ms"] = round(percentile(ok, 99) * 1000, 2)
+    if args.pid:
+        report["server_rss_kib"] = rss_kib(args.pid)
+    print(json.dumps(report, indent=2))
+
+    for writer in holders:
+        writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--idle", type=int, default=1000)
+    parser.add_argument("--mode", choices=["idle", "slow"], default="slow")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--path", default="/process")
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument("--pid", type=int, help="server pid, for RSS")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
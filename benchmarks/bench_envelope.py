@@ -0,0 +1,99 @@
+"""Upload size, parse CPU and peak memory: JSON envelope vs binary envelope.
+
+Run from the project root (needs priv_sets.py and the RSA key pair):
+
+    python benchmarks/bench_envelope.py --pages 10 --page-bytes 500000
+"""
+
+import argparse
+import base64
+import json
+import os
+import struct
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+def build_legacy(pages, file_lib, key):
+    inner = json.dumps(
+        {
+            "to_process": [base64.b64encode(p).decode() for p in pages],
+            "file_lib": file_lib,
+        }
+    )
+    content = app.aes_encrypt(inner, key)
+    return json.dumps({"client_id": "bench", "content": content}).encode()
+
+
+def build_binary(pages, file_lib, key):
+    sections = [app.aes_encrypt_bytes(json.dumps({"file_lib": file_lib}), key)]
+    for page in pages:
+        sections.append(app.aes_encrypt_bytes(page, key))
+    body = b"".join(struct.pack(">I", len(s)) + s for s in sections)
+    header = json.dumps({"client_id": "bench"}).encode()
+    return (
+        app.ENVELOPE_MAGIC
+        + bytes([1])
+        + struct.pack(">I", len(header))
+        + header
+        + body
+    )
+
+
+def parse_legacy(raw, key):
+    data = json.loads(raw)
+    inner = json.loads(app.aes_decrypt(data["content"], key))
+    return [base64.b64decode(p) for p in inner["to_process"]]
+
+
+def parse_binary(raw, key):
+    data = app.parse_envelope(raw)
+    sections = data["sections"]
+    json.loads(app.aes_decrypt_bytes(sections[0], key))
+    return [app.aes_decrypt_bytes(s, key) for s in sections[1:]]
+
+
+def measure(parse, raw, key, repeat):
+    start = time.process_time()
+    for _ in range(repeat):
+        parse(raw, key)
+    cpu = (time.process_time() - start) / repeat
+    tracemalloc.start()
+    parse(raw, key)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--page-bytes", type=int, default=500 * 1024)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    key = os.urandom(32)
+    pages = [os.urandom(args.page_bytes) for _ in range(args.pages)]
+    with open("static/mockup_file_lib.json", "r", encoding="utf-8") as f:
+        file_lib = json.load(f)
+
+    for name, build, parse in [
+        ("json+base64", build_legacy, parse_legacy),
+        ("binary", build_binary, parse_binary),
+    ]:
+        raw = build(pages, file_lib, key)
+        cpu, peak = measure(parse, raw, key, args.repeat)
+        print(
+            f"{name:12} upload={len(raw) / 1024 / 1024:7.2f} MiB "
+            f"parse={cpu * 1000:8.2f} ms CPU "
+            f"peak={peak / 1024 / 1024:7.2f} MiB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""Microbenchmarks of the per-request CPU work in app.py, with baselines.
+
+Run from the project root (needs priv_sets.py and the RSA key pair):
+
+    python benchmarks/bench_hot_path.py
+    python benchmarks/bench_hot_path.py --save benchmarks/baselines/me.json
+    python benchmarks/bench_hot_path.py \
+        --compare benchmarks/baselines/me.json --threshold 0.15
+
+Fixtures are generated from a fixed seed, so every run times the same
+inputs. Each benchmark is timed in --repeats rounds of enough calls to
+last about --min-time seconds. The fastest round is the least disturbed
+by other load, so --compare uses it: it exits with status 1 when a
+benchmark's best time per call got slower than its baseline by more than
+--threshold. Baselines only hold for the machine and Python they were
+saved on; --compare warns when the environment differs.
+"""
+
+import argparse
+import base64
+import gc
+import hashlib
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+from bench_upload_cpu import wrap_key
+from form_prefill import build_index, prefill_form
+
+SEED = 20250801
+AES_KEY = bytes(range(32))
+
+
+def random_text(rng, words):
+    return " ".join(
+        "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(6))
+        for _ in range(words)
+    )
+
+
+def build_payload(rng, pages, page_bytes, file_lib):
+    """Inner JSON of a doc upload: base64 pages and the file_lib"""
+    images = [
+        base64.b64encode(rng.randbytes(page_bytes)).decode()
+        for _ in range(pages)
+    ]
+    return json.dumps({"to_process": images, "file_lib": file_lib})
+
+
+def build_file_lib(rng, entries, keys):
+    return {
+        kind: [
+            {
+                "id": f"{kind}-{i:05d}",
+                "title": random_text(rng, 4),
+                "tags": [random_text(rng, 1) for _ in range(5)],
+                "description": random_text(rng, 30),
+                "kv": {f"Field {j}": random_text(rng, 3) for j in range(keys)},
+            }
+            for i in range(entries)
+        ]
+        for kind in ["doc", "form"]
+    }
+
+
+def build_deep_kv(depth, fanout):
+    if depth == 0:
+        return "value"
+    return {f"k{i}": build_deep_kv(depth - 1, fanout) for i in range(fanout)}
+
+
+def build_llm_output(rng, blocks, words):
+    parts = []
+    for _ in range(blocks):
+        parts.append(f"<think>{random_text(rng, words)}</think>")
+        parts.append(random_text(rng, words // 4))
+    return "\n".join(parts)
+
+
+def build_benchmarks():
+    """Map benchmark names to zero-argument callables"""
+    rng = random.Random(SEED)
+    file_lib = build_file_lib(rng, 250, 30)
+    payload = build_payload(rng, 3, 300 * 1024, file_lib)
+    cbc_content = app.aes_encrypt(payload, AES_KEY, "cbc")
+    gcm_content = app.aes_encrypt(payload, AES_KEY, "gcm")
+    wrapped_key = wrap_key(AES_KEY)
+    wide_kv = {f"Field {i}": random_text(rng, 3) for i in range(5000)}
+    deep_kv = build_deep_kv(7, 4)
+    llm_output = build_llm_output(rng, 50, 800)
+    ocr_text = random_text(rng, 3000)
+    form = {
+        "title": "Form",
+        "kv": {},
+        "fields": [f"Field {i}" for i in range(0, 60, 2)]
+        + [f"Unknown {i}" for i in range(30)],
+    }
+    index = build_index(file_lib)
+    result = json.dumps({"kv": wide_kv})
+
+    return {
+        "rsa_decrypt_key": lambda: app.rsa_decrypt_key(wrapped_key),
+        "aes_decrypt_cbc_1mb": lambda: app.aes_decrypt(
+            cbc_content, AES_KEY, "cbc"
+        ),
+        "aes_decrypt_gcm_1mb": lambda: app.aes_decrypt(
+            gcm_content, AES_KEY, "gcm"
+        ),
+        "aes_encrypt_cbc_1mb": lambda: app.aes_encrypt(
+            payload, AES_KEY, "cbc"
+        ),
+        "aes_encrypt_gcm_result": lambda: app.aes_encrypt(
+            result, AES_KEY, "gcm"
+        ),
+        "sha256_content_1mb": lambda: hashlib.sha256(
+            cbc_content.encode()
+        ).hexdigest(),
+        "expand_json_wide_5000": lambda: app.expand_json(wide_kv),
+        "expand_json_deep_7x4": lambda: app.expand_json(deep_kv),
+        "remove_think_tags_long": lambda: app.remove_think_tags(llm_output),
+        "construct_prompt_doc": lambda: app.construct_prompt_doc(
+            ocr_text, file_lib
+        ),
+        "construct_prompt_form": lambda: app.construct_prompt_form(
+            ocr_text, file_lib
+        ),
+        "construct_prompt_fill": lambda: app.construct_prompt_fill(
+            form, file_lib
+        ),
+        "prefill_build_index": lambda: build_index(file_lib),
+        "prefill_form": lambda: prefill_form(form, index),
+    }
+
+
+def time_call(func, repeats, min_time):
+    """(median, best) seconds per call over repeats rounds"""
+    func()
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 10:
+            break
+        loops *= 10
+    loops = max(1, int(loops * min_time / elapsed))
+    rounds = []
+    # Like timeit, keep garbage collection pauses out of the rounds.
+    gc.disable()
+    try:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for _ in range(loops):
+                func()
+            rounds.append((time.perf_counter() - start) / loops)
+    finally:
+        gc.enable()
+    return statistics.median(rounds), min(rounds)
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor() or platform.machine(),
+        "system": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print the change against baseline; returns the regressed names"""
+    regressions = []
+    for name, current in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            print(f"{name:28s} {current['min_us']:12.1f} us  (new)")
+            continue
+        change = current["min_us"] / before["min_us"] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(
+            f"{name:28s} {current['min_us']:12.1f} us  "
+            f"baseline {before['min_us']:12.1f} us  "
+            f"{change * 100:+6.1f}%{flag}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--filter", default="", help="run matching names")
+    parser.add_argument("--repeats", type=int, default=7)
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--save", help="write results as a baseline")
+    parser.add_argument("--compare", help="baseline file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.15)
+    args = parser.parse_args()
+
+    benchmarks = {
+        name: func
+        for name, func in build_benchmarks().items()
+        if args.filter in name
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["environment"] != environment():
+            print(
+                "warning: baseline was saved in a different environment: "
+                f"{baseline['environment']}",
+                file=sys.stderr,
+            )
+
+    results = {}
+    for name, func in benchmarks.items():
+        median, best = time_call(func, args.repeats, args.min_time)
+        results[name] = {"median_us": median * 1e6, "min_us": best * 1e6}
+        if baseline is None:
+            print(
+                f"{name:28s} {best * 1e6:12.1f} us  "
+                f"(median {median * 1e6:.1f})"
+            )
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.save) or ".", exist_ok=True)
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(
+                {"environment": environment(), "results": results},
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+            f.write("\n")
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(
+                f"{len(regressions)} regression(s) beyond "
+                f"{args.threshold * 100:.0f}%: {', '.join(regressions)}"
+            )
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
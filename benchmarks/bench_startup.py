@@ -0,0 +1,91 @@
+"""Import time of app.py and server cold start to first served request.
+
+Run from the project root (needs priv_sets.py and the RSA key pair):
+
+    python benchmarks/bench_startup.py --runs 5
+    python benchmarks/bench_startup.py --server \
+        "gunicorn -w 4 --threads 20 --preload app:create_app()"
+
+The server command must listen on --port; each run starts it, polls
+/check_status until the first 200 and stops it again.
+"""
+
+import argparse
+import shlex
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+IMPORT_SNIPPET = (
+    "import time; start = time.perf_counter(); import app; "
+    "print(time.perf_counter() - start)"
+)
+
+
+def time_import():
+    out = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def time_first_request(command, port, timeout):
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        shlex.split(command),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(
+                    f"http://127.0.0.1:{port}/check_status", timeout=1
+                ) as r:
+                    if r.status == 200:
+                        return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.01)
+        return None
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def report(name, values):
+    values = [v for v in values if v is not None]
+    if not values:
+        print(f"{name}: no successful run")
+        return
+    print(
+        f"{name}: median {statistics.median(values) * 1000:.0f} ms, "
+        f"max {max(values) * 1000:.0f} ms over {len(values)} runs"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--server", action="append", default=[])
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+
+    report("import app", [time_import() for _ in range(args.runs)])
+    for command in args.server:
+        report(
+            command,
+            [
+                time_first_request(command, args.port, args.timeout)
+                for _ in range(args.runs)
+            ],
+        )
+
+
+if __name__ == "__main__":
+    main()
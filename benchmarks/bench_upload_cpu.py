@@ -0,0 +1,105 @@
+"""Request-side CPU per upload: per-request RSA key unwrap vs session key.
+
+"session key, other worker" drops the in-process cache before every
+lookup, as when the upload lands on a worker that did not register it.
+
+Run from the project root (needs priv_sets.py and the RSA key pair):
+
+    python benchmarks/bench_upload_cpu.py --uploads 200 --pages 3
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding as asym_padding
+
+import app
+from priv_sets import RSA_PUBLIC_KEY
+
+
+def build_payload(pages, page_bytes):
+    images = [
+        base64.b64encode(os.urandom(page_bytes)).decode() for _ in range(pages)
+    ]
+    with open("static/mockup_file_lib.json", "r", encoding="utf-8") as f:
+        file_lib = json.load(f)
+    return json.dumps({"to_process": images, "file_lib": file_lib})
+
+
+def wrap_key(aes_key):
+    public_key = serialization.load_pem_public_key(RSA_PUBLIC_KEY.encode())
+    wrapped = public_key.encrypt(
+        aes_key,
+        asym_padding.OAEP(
+            mgf=asym_padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None,
+        ),
+    )
+    return base64.b64encode(wrapped).decode()
+
+
+def run_legacy(uploads, wrapped_key, content):
+    start = time.process_time()
+    for _ in range(uploads):
+        key = app.rsa_decrypt_key(wrapped_key)
+        json.loads(app.aes_decrypt(content, key, "cbc"))
+    return time.process_time() - start
+
+
+def run_session(uploads, client_id, wrapped_key, content, shared=False):
+    start = time.process_time()
+    key_id = app.register_session_key(
+        client_id, app.rsa_decrypt_key(wrapped_key)
+    )
+    for _ in range(uploads):
+        if shared:
+            app.session_keys.clear()
+        key = app.lookup_session_key(client_id, key_id)
+        json.loads(app.aes_decrypt(content, key, "gcm"))
+    return time.process_time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--uploads", type=int, default=200)
+    parser.add_argument("--pages", type=int, default=3)
+    parser.add_argument("--page-bytes", type=int, default=200 * 1024)
+    args = parser.parse_args()
+
+    app.preload()
+    aes_key = os.urandom(32)
+    wrapped_key = wrap_key(aes_key)
+    payload = build_payload(args.pages, args.page_bytes)
+    cbc_content = app.aes_encrypt(payload, aes_key, "cbc")
+    gcm_content = app.aes_encrypt(payload, aes_key, "gcm")
+
+    legacy = run_legacy(args.uploads, wrapped_key, cbc_content)
+    session = run_session(
+        args.uploads, "bench-client", wrapped_key, gcm_content
+    )
+    shared = run_session(
+        args.uploads, "bench-client", wrapped_key, gcm_content, shared=True
+    )
+
+    print(
+        f"uploads={args.uploads} pages={args.pages} "
+        f"payload={len(cbc_content) / 1024:.0f} KiB"
+    )
+    print(f"rsa per upload + cbc: {legacy / args.uploads * 1000:.3f} ms CPU")
+    print(f"session key + gcm:    {session / args.uploads * 1000:.3f} ms CPU")
+    print(
+        "session key, other worker + gcm: "
+        f"{shared / args.uploads * 1000:.3f} ms CPU"
+    )
+
+
+if __name__ == "__main__":
+    main()
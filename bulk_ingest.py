@@ -0,0 +1,466 @@
+"""Bulk ingestion for archive imports and reprocessing runs.
+
+Reads /process request bodies from a JSONL manifest or a directory (*.json
+bodies, *.jsonl manifests and binary *.dsnp envelopes), runs OCR locally
+and sends the prompts through the LLM provider's batch interface instead
+of the interactive queue. Results are written to tasks.db as if the
+documents had been processed online, so clients fetch them with
+has_content false. Request bodies must carry an RSA-wrapped aes_key;
+session key_ids do not outlive the server process.
+
+    python bulk_ingest.py archive.jsonl --state archive.state.json
+
+Progress is kept in the state file. Rerunning the same command resumes:
+finished documents are skipped and submitted batches are collected instead
+of being sent again. Use a fresh state file for a new reprocessing run.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import app
+from llm_router import LLMBatchFailed
+
+BATCH_SIZE = 100
+OCR_WORKERS = 4
+MAX_INTERACTIVE_TASKS = 2
+THROTTLE_SLEEP = 5
+BATCH_POLL_INTERVAL = 30
+PROGRESS_INTERVAL = 10
+
+
+def load_entries(source):
+    """Yield /process request bodies from a manifest file or directory"""
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            path = os.path.join(source, name)
+            try:
+                if name.endswith(".jsonl"):
+                    yield from load_entries(path)
+                elif name.endswith(".json"):
+                    with open(path, "r", encoding="utf-8") as f:
+                        yield request_body(f.read())
+                elif name.endswith(".dsnp"):
+                    with open(path, "rb") as f:
+                        yield app.parse_envelope(f.read())
+            except ValueError as e:
+                print(f"Skipping {path}: {str(e)}", file=sys.stderr)
+        return
+    with open(source, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                data = request_body(line)
+            except ValueError as e:
+                print(f"Skipping {source}:{number}: {str(e)}", file=sys.stderr)
+                continue
+            yield data
+
+
+def request_body(text):
+    data = json.loads(text)
+    if not isinstance(data, dict):
+        raise ValueError("not a JSON object")
+    return data
+
+
+def entry_id(data):
+    return f"{data['client_id']}/{data['type']}/{data['SHA256']}"
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {"done": [], "failed": {}, "batches": {}}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_state(path, state):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def is_completed(data):
+    with sqlite3.connect("tasks.db") as conn:
+        row = conn.execute(
+            """
+            SELECT status
+            FROM tasks
+            WHERE client_id = ?
+            AND sha256 = ?
+            AND type = ?
+            """,
+            (data["client_id"], data["SHA256"], data["type"]),
+        ).fetchone()
+    return row is not None and row[0] == "completed"
+
+
+def interactive_tasks():
+    with sqlite3.connect("tasks.db") as conn:
+        return conn.execute(
+            "SELECT COUNT(*) FROM tasks WHERE status = 'processing'"
+        ).fetchone()[0]
+
+
+def wait_for_headroom(max_interactive):
+    """Hold back OCR while the server is busy with interactive tasks"""
+    while interactive_tasks() > max_interactive:
+        time.sleep(THROTTLE_SLEEP)
+
+
+def build_task(data, decrypt_content=True):
+    """Validate a request body and turn it into a worker task dict"""
+    for field in ["client_id", "type", "SHA256", "content", "aes_key"]:
+        if field not in data:
+            raise ValueError("MISSING_REQUIRED_FIELD")
+    if data["type"] not in ["doc", "form", "fill"]:
+        raise ValueError("INVALID_TYPE")
+    cipher_mode = data.get("cipher", "cbc")
+    if cipher_mode not in ["cbc", "gcm"]:
+        raise ValueError("INVALID_CIPHER")
+    if decrypt_content:
+        content, aes_key_bytes = app.decode_submission(
+            data, data["client_id"], data["SHA256"], data["type"], cipher_mode
+        )
+    else:
+        content = None
+        aes_key_bytes = app.resolve_aes_key(data, data["client_id"])
+    return {
+        "client_id": data["client_id"],
+        "sha256": data["SHA256"],
+        "type": data["type"],
+        "content": content,
+        "aes_key": aes_key_bytes,
+        "cipher": cipher_mode,
+    }
+
+
+def prepare(data, max_interactive):
+    """Decrypt and OCR one document; returns (task, prompt, pages, prefilled).
+
+    The returned task has its content dropped so that only prompts waiting
+    for a batch stay in memory. prefilled holds the fill fields resolved
+    without the LLM. prompt is None for a fill task that was pre-filled
+    completely; its result is already stored.
+    """
+    task = build_task(data)
+    content = task["content"]
+    pages = 0 if task["type"] == "fill" else len(content["to_process"])
+    checkpoints = app.read_checkpoints(task)
+    prompt = checkpoints.get("prompt")
+    prefilled = json.loads(checkpoints.get("prefill", "{}"))
+    if prompt is None:
+        if task["type"] == "fill":
+            prefilled, prompt = app.prepare_fill(task, content)
+            if prompt is None:
+                save_result(task, json.dumps(prefilled))
+                return task, None, pages, prefilled
+        else:
+            done_pages = {
+                int(stage.split(":", 1)[1]): text
+                for stage, text in checkpoints.items()
+                if stage.startswith("ocr:")
+            }
+            wait_for_headroom(max_interactive)
+            try:
+                text = app.images_to_text(
+                    content["to_process"],
+                    done_pages,
+                    lambda i, page_text: app.write_checkpoint(
+                        task, f"ocr:{i}", page_text
+                    ),
+                )
+            except Exception:
+                raise ValueError("OCR_FAILURE")
+            if task["type"] == "doc":
+                prompt = app.construct_prompt_doc(text, content["file_lib"])
+            else:
+                prompt = app.construct_prompt_form(text, content["file_lib"])
+        app.write_checkpoint(task, "prompt", prompt)
+    task["content"] = None
+    return task, prompt, pages, prefilled
+
+
+def store_result(task, output, pages, prefilled):
+    """Parse a batch output and write it to the task store"""
+    checkpoints = app.read_checkpoints(task)
+    prompt = checkpoints.get("prompt")
+    if prompt is None:
+        # The prompt checkpoint expired, so a bad output cannot be repaired.
+        _, missing = app.parse_llm_output(output, task["type"])
+        if missing:
+            raise ValueError(f"LLM output missing {missing}")
+        prompt = ""
+    result = app.call_llm(prompt, task["type"], pages, output=output)
+    save_result(task, app.merge_prefill(result, prefilled))
+
+
+def save_result(task, result):
+    current_time = app.get_current_utc_time()
+    with sqlite3.connect("tasks.db") as conn:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO tasks (
+                client_id,
+                sha256,
+                type,
+                status,
+                created_at,
+                last_accessed
+            ) VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (
+                task["client_id"],
+                task["sha256"],
+                task["type"],
+                "processing",
+                current_time,
+                current_time,
+            ),
+        )
+        conn.commit()
+    app.write_result_to_cache(task, result)
+    app.delete_checkpoints(task["client_id"], task["sha256"], task["type"])
+
+
+class BulkIngest:
+    def __init__(self, args):
+        self.args = args
+        self.provider = app.llm_router.provider
+        self.state = load_state(args.state)
+        self.done = set(self.state["done"])
+        self.tasks = {}
+        self.queued = {}
+        self.counts = {"seen": 0, "skipped": 0, "prepared": 0}
+        self.last_poll = 0.0
+        self.last_report = 0.0
+
+    def record_done(self, eid):
+        self.done.add(eid)
+        self.state["done"].append(eid)
+        self.state["failed"].pop(eid, None)
+
+    def record_failure(self, eid, error_code):
+        print(f"{eid}: {error_code}", file=sys.stderr)
+        self.state["failed"][eid] = error_code
+
+    def submit(self, model):
+        entries = self.queued.pop(model)
+        batch_id = self.provider.submit_batch(
+            model, {eid: prompt for eid, (prompt, _, _) in entries.items()}
+        )
+        # Checkpoints expire long before a batch may finish, so pre-filled
+        # fields are kept in the state file, encrypted with the task's key.
+        self.state["batches"][batch_id] = {
+            "model": model,
+            "entries": {
+                eid: {
+                    "pages": pages,
+                    "prefill": (
+                        app.aes_encrypt(
+                            json.dumps(prefilled),
+                            self.tasks[eid]["aes_key"],
+                            "gcm",
+                        )
+                        if prefilled
+                        else None
+                    ),
+                }
+                for eid, (_, pages, prefilled) in entries.items()
+            },
+        }
+        save_state(self.args.state, self.state)
+
+    def poll(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_poll < self.args.poll_interval:
+            return
+        self.last_poll = now
+        for batch_id, info in list(self.state["batches"].items()):
+            try:
+                outputs = self.provider.poll_batch(batch_id)
+            except LLMBatchFailed as e:
+                print(str(e), file=sys.stderr)
+                outputs = {}
+            except Exception as e:
+                print(f"Polling {batch_id} failed: {str(e)}", file=sys.stderr)
+                continue
+            if outputs is None:
+                continue
+            for eid, entry in info["entries"].items():
+                if isinstance(entry, int):
+                    # State files written before pre-fill was kept here.
+                    entry = {"pages": entry, "prefill": None}
+                task = self.tasks.pop(eid, None)
+                if task is None:
+                    self.record_failure(eid, "TASK_NOT_FOUND")
+                    continue
+                output = outputs.get(eid)
+                if output is None:
+                    self.record_failure(eid, "LLM_FAILURE")
+                    continue
+                try:
+                    prefilled = {}
+                    if entry["prefill"]:
+                        prefilled = json.loads(
+                            app.aes_decrypt(
+                                entry["prefill"], task["aes_key"], "gcm"
+                            )
+                        )
+                    store_result(task, output, entry["pages"], prefilled)
+                except Exception:
+                    self.record_failure(eid, "LLM_FAILURE")
+                    continue
+                self.record_done(eid)
+            del self.state["batches"][batch_id]
+            save_state(self.args.state, self.state)
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_report < PROGRESS_INTERVAL:
+            return
+        self.last_report = now
+        in_batches = sum(
+            len(info["entries"]) for info in self.state["batches"].values()
+        )
+        queued = sum(len(entries) for entries in self.queued.values())
+        print(
+            f"seen {self.counts['seen']} "
+            f"skipped {self.counts['skipped']} "
+            f"prepared {self.counts['prepared']} "
+            f"queued {queued} "
+            f"in batches {in_batches} "
+            f"done {len(self.done)} "
+            f"failed {len(self.state['failed'])}",
+            file=sys.stderr,
+        )
+
+    def collect(self, futures, timeout):
+        finished, _ = wait(
+            list(futures), timeout=timeout, return_when=FIRST_COMPLETED
+        )
+        for future in finished:
+            eid = futures.pop(future)
+            try:
+                task, prompt, pages, prefilled = future.result()
+            except ValueError as e:
+                self.record_failure(eid, str(e))
+                continue
+            except Exception as e:
+                print(f"{eid}: {str(e)}", file=sys.stderr)
+                self.record_failure(eid, "PROCESSING_ERROR")
+                continue
+            self.counts["prepared"] += 1
+            if prompt is None:
+                self.record_done(eid)
+                continue
+            self.tasks[eid] = task
+            model = app.llm_router.route(task["type"], pages, len(prompt))
+            self.queued.setdefault(model, {})[eid] = (
+                prompt,
+                pages,
+                prefilled,
+            )
+            if len(self.queued[model]) >= self.args.batch_size:
+                self.submit(model)
+        self.poll()
+        self.report()
+
+    def should_skip(self, eid, data):
+        if eid in self.done:
+            return True
+        if eid in self.state["failed"] and not self.args.retry_failed:
+            return True
+        if not self.args.force and is_completed(data):
+            self.record_done(eid)
+            return True
+        return False
+
+    def run(self):
+        in_batches = {
+            eid
+            for info in self.state["batches"].values()
+            for eid in info["entries"]
+        }
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.args.ocr_workers) as pool:
+            for data in load_entries(self.args.source):
+                self.counts["seen"] += 1
+                try:
+                    eid = entry_id(data)
+                except KeyError:
+                    print("Skipping entry without id fields", file=sys.stderr)
+                    self.counts["skipped"] += 1
+                    continue
+                if eid in in_batches:
+                    # Submitted by an earlier run; only the key is needed.
+                    try:
+                        self.tasks[eid] = build_task(data, False)
+                    except ValueError as e:
+                        self.record_failure(eid, str(e))
+                    continue
+                if self.should_skip(eid, data):
+                    self.counts["skipped"] += 1
+                    continue
+                while len(futures) >= 2 * self.args.ocr_workers:
+                    self.collect(futures, PROGRESS_INTERVAL)
+                futures[
+                    pool.submit(prepare, data, self.args.max_interactive)
+                ] = eid
+            while futures:
+                self.collect(futures, PROGRESS_INTERVAL)
+
+        for model in list(self.queued):
+            self.submit(model)
+        self.poll(force=True)
+        while self.state["batches"]:
+            self.report()
+            time.sleep(min(self.args.poll_interval, PROGRESS_INTERVAL))
+            self.poll()
+        save_state(self.args.state, self.state)
+        self.report(force=True)
+        return 1 if self.state["failed"] else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("source", help="JSONL manifest or directory")
+    parser.add_argument("--state", default="bulk_ingest.state.json")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--ocr-workers", type=int, default=OCR_WORKERS)
+    parser.add_argument(
+        "--max-interactive",
+        type=int,
+        default=MAX_INTERACTIVE_TASKS,
+        help="pause OCR while more interactive tasks are processing",
+    )
+    parser.add_argument(
+        "--poll-interval", type=float, default=BATCH_POLL_INTERVAL
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="reprocess documents that already have a result",
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="retry documents that failed in an earlier run",
+    )
+    args = parser.parse_args()
+    app.start_runtime(workers=False)
+    if not hasattr(app.llm_router.provider, "submit_batch"):
+        sys.exit("The configured LLM provider has no batch interface")
+    sys.exit(BulkIngest(args).run())
+
+
+if __name__ == "__main__":
+    main()
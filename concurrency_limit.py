@@ -0,0 +1,178 @@
+"""Adaptive concurrency limits for outbound calls to OCR and LLM backends.
+
+Each limiter is an AIMD window: every successful call adds 1/limit to the
+limit, so a fully used limit grows by one per round of calls. An overload
+signal multiplies it by BACKOFF_RATIO, at most once per observed latency
+so a burst of failures from one round counts once. Overload signals are
+failed calls (connection errors, timeouts, 5xx and 429) and, when
+latency_tolerance is set, a recent latency that exceeds the no-load
+baseline by that factor. A Retry-After from the backend also blocks new
+calls until it has passed.
+"""
+
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import httpx
+import requests
+
+BACKOFF_RATIO = 0.5
+LATENCY_BACKOFF_RATIO = 0.9
+LATENCY_ALPHA = 0.2
+BASELINE_DRIFT = 0.01
+MAX_RETRY_AFTER = 300.0
+WAIT_SLICE = 0.5
+
+# Failures to reach a backend in time. SDK errors (like zhipuai's
+# APIConnectionError) are matched by the transport error they wrap.
+TRANSPORT_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    requests.ConnectionError,
+    requests.Timeout,
+    httpx.TransportError,
+)
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header value, or None"""
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        seconds = (when - datetime.now(timezone.utc)).total_seconds()
+    return min(MAX_RETRY_AFTER, max(0.0, seconds))
+
+
+def is_transport_error(error):
+    seen = 0
+    while error is not None and seen < 5:
+        if isinstance(error, TRANSPORT_ERRORS):
+            return True
+        error = error.__cause__
+        seen += 1
+    return False
+
+
+def classify_failure(error):
+    """Return (overload, retry_after) for an exception from a backend call.
+
+    Only connection errors, timeouts, 5xx, 429 and a Retry-After count as
+    overload. Any other error, such as a 4xx, a task the backend reported
+    as failed or a malformed reply, says nothing about backend capacity.
+    """
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    headers = getattr(response, "headers", None) or {}
+    retry_after = parse_retry_after(headers.get("Retry-After"))
+    if status is None:
+        overload = is_transport_error(error)
+    else:
+        overload = status >= 500 or status == 429
+    return overload or retry_after is not None, retry_after
+
+
+class AdaptiveLimiter:
+    def __init__(
+        self, name, initial, min_limit=1, max_limit=None, latency_tolerance=2.0
+    ):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit or initial
+        self.limit = float(min(self.max_limit, max(min_limit, initial)))
+        self.latency_tolerance = latency_tolerance
+        self.inflight = 0
+        self.latency = None
+        self.baseline = None
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+        self.successes = 0
+        self.overloads = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, cancel_event=None):
+        """Wait for a free slot; returns False if cancel_event is set first"""
+        with self.cond:
+            while True:
+                if cancel_event is not None and cancel_event.is_set():
+                    return False
+                blocked = self.blocked_until - time.monotonic()
+                if blocked <= 0 and self.inflight < int(self.limit):
+                    self.inflight += 1
+                    return True
+                self.cond.wait(
+                    min(blocked, WAIT_SLICE) if blocked > 0 else WAIT_SLICE
+                )
+
+    def release(self, latency=None, overload=False, retry_after=None):
+        """Free a slot and record the call's outcome.
+
+        Pass the latency of a successful call, or overload=True for a call
+        that failed because the backend is saturated. A call released with
+        neither (cancelled, or rejected as a bad request) is not counted.
+        """
+        with self.cond:
+            now = time.monotonic()
+            self.inflight -= 1
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+            if overload or retry_after:
+                self.overloads += 1
+                self._decrease(now, BACKOFF_RATIO)
+            elif latency is not None:
+                self.successes += 1
+                self._record_latency(latency)
+                if (
+                    self.latency_tolerance
+                    and self.latency > self.baseline * self.latency_tolerance
+                ):
+                    self._decrease(now, LATENCY_BACKOFF_RATIO)
+                elif self.inflight + 1 >= self.limit / 2:
+                    # Only grow a limit that is actually being used.
+                    self.limit = min(
+                        self.max_limit, self.limit + 1 / self.limit
+                    )
+            self.cond.notify_all()
+
+    def _record_latency(self, latency):
+        if self.latency is None:
+            self.latency = latency
+            self.baseline = latency
+            return
+        self.latency += LATENCY_ALPHA * (latency - self.latency)
+        self.baseline = min(latency, self.baseline * (1 + BASELINE_DRIFT))
+
+    def _decrease(self, now, ratio):
+        if now - self.last_decrease < (self.latency or 0):
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit * ratio)
+
+    def snapshot(self):
+        with self.cond:
+            return {
+                "limit": int(self.limit),
+                "inflight": self.inflight,
+                "min_limit": self.min_limit,
+                "max_limit": self.max_limit,
+                "latency_ms": (
+                    round(self.latency * 1000, 1) if self.latency else None
+                ),
+                "baseline_ms": (
+                    round(self.baseline * 1000, 1) if self.baseline else None
+                ),
+                "blocked_seconds": round(
+                    max(0.0, self.blocked_until - time.monotonic()), 1
+                ),
+                "successes": self.successes,
+                "overloads": self.overloads,
+            }
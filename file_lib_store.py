@@ -0,0 +1,189 @@
+"""Per-client file_lib store with version numbers and delta updates.
+
+A client uploads its file_lib once, then sends only the entries that were
+added, changed or removed. Each update bumps the client's version; /process
+payloads can then carry "file_lib_version" instead of the whole library.
+Versions are never reused, so a (client_id, version) pair always names the
+same library. Parsed libraries are cached in memory by that pair, along
+with their JSON text for the prompts and their fill pre-fill index.
+Libraries are stored AES-GCM encrypted with a server key, bound to the
+client_id.
+"""
+
+import base64
+import json
+import os
+import sqlite3
+import threading
+
+from cachetools import LRUCache
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from form_prefill import build_index
+
+FILE_LIB_KINDS = ["doc", "form"]
+FILE_LIB_CACHE_SIZE = 1000
+
+
+def empty_file_lib():
+    return {kind: [] for kind in FILE_LIB_KINDS}
+
+
+def validate_file_lib(lib):
+    if not isinstance(lib, dict):
+        raise ValueError("INVALID_FILE_LIB")
+    for kind in FILE_LIB_KINDS:
+        entries = lib.get(kind, [])
+        if not isinstance(entries, list) or not all(
+            isinstance(entry, dict) for entry in entries
+        ):
+            raise ValueError("INVALID_FILE_LIB")
+    return {kind: list(lib.get(kind, [])) for kind in FILE_LIB_KINDS}
+
+
+def apply_ops(lib, ops):
+    """Apply put (add or modify by id) and remove ops to a copy of lib"""
+    if not isinstance(ops, list):
+        raise ValueError("INVALID_FILE_LIB_OP")
+    lib = {kind: list(lib.get(kind, [])) for kind in FILE_LIB_KINDS}
+    for op in ops:
+        if not isinstance(op, dict) or op.get("kind") not in FILE_LIB_KINDS:
+            raise ValueError("INVALID_FILE_LIB_OP")
+        entries = lib[op["kind"]]
+        if op.get("op") == "put":
+            entry = op.get("entry")
+            if not isinstance(entry, dict) or "id" not in entry:
+                raise ValueError("INVALID_FILE_LIB_OP")
+            for i, existing in enumerate(entries):
+                if existing.get("id") == entry["id"]:
+                    entries[i] = entry
+                    break
+            else:
+                entries.append(entry)
+        elif op.get("op") == "remove":
+            if "id" not in op:
+                raise ValueError("INVALID_FILE_LIB_OP")
+            lib[op["kind"]] = [e for e in entries if e.get("id") != op["id"]]
+        else:
+            raise ValueError("INVALID_FILE_LIB_OP")
+    return lib
+
+
+class StoredFileLib:
+    """One immutable library version with what is derived from it"""
+
+    def __init__(self, version, lib):
+        self.version = version
+        self.lib = lib
+        self.text = json.dumps(lib)
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = build_index(self.lib)
+        return self._index
+
+
+class FileLibStore:
+    def __init__(self, db_path, key):
+        self.db_path = db_path
+        self.aesgcm = AESGCM(key)
+        self.cache = LRUCache(maxsize=FILE_LIB_CACHE_SIZE)
+        self.lock = threading.Lock()
+
+    def _encrypt(self, client_id, lib):
+        nonce = os.urandom(12)
+        data = self.aesgcm.encrypt(
+            nonce, json.dumps(lib).encode(), client_id.encode()
+        )
+        return base64.b64encode(nonce + data).decode()
+
+    def _decrypt(self, client_id, data):
+        raw = base64.b64decode(data)
+        return json.loads(
+            self.aesgcm.decrypt(raw[:12], raw[12:], client_id.encode())
+        )
+
+    def _remember(self, client_id, version, lib):
+        entry = StoredFileLib(version, lib)
+        with self.lock:
+            self.cache[(client_id, version)] = entry
+        return entry
+
+    def current_version(self, client_id):
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute(
+                "SELECT version FROM file_libs WHERE client_id = ?",
+                (client_id,),
+            ).fetchone()
+        return row[0] if row else 0
+
+    def lookup(self, client_id, version):
+        """Return the StoredFileLib of this version, if it is the current one
+
+        The cache may still hold older versions, so a cached library is
+        only returned after checking the stored version number.
+        """
+        with self.lock:
+            entry = self.cache.get((client_id, version))
+        if entry is not None and self.current_version(client_id) == version:
+            return entry
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute(
+                "SELECT version, data FROM file_libs WHERE client_id = ?",
+                (client_id,),
+            ).fetchone()
+        if row is None:
+            raise ValueError("FILE_LIB_NOT_FOUND")
+        if row[0] != version:
+            raise ValueError("FILE_LIB_VERSION_MISMATCH")
+        return self._remember(
+            client_id, version, self._decrypt(client_id, row[1])
+        )
+
+    def update(self, client_id, base_version, ops=None, replace=None):
+        """Apply ops on top of base_version, or replace the whole library.
+
+        Returns the new version. Ops against a stale base_version raise
+        FILE_LIB_VERSION_CONFLICT; replace always succeeds.
+        """
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT version, data FROM file_libs WHERE client_id = ?",
+                (client_id,),
+            ).fetchone()
+            current = row[0] if row else 0
+            if replace is not None:
+                lib = validate_file_lib(replace)
+            elif base_version != current:
+                raise ValueError("FILE_LIB_VERSION_CONFLICT")
+            else:
+                base = (
+                    self._decrypt(client_id, row[1])
+                    if row
+                    else empty_file_lib()
+                )
+                lib = apply_ops(base, ops or [])
+            version = current + 1
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO file_libs (
+                    client_id,
+                    version,
+                    data
+                ) VALUES (?, ?, ?)
+                """,
+                (client_id, version, self._encrypt(client_id, lib)),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        self._remember(client_id, version, lib)
+        return version
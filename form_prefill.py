@@ -0,0 +1,183 @@
+"""Deterministic pre-fill of fill tasks from the file_lib kv data.
+
+Most form fields use the DEFAULT_FIELDS names from prompts.py, and so do
+the kv keys of processed documents, so many fields can be filled without
+the LLM. A field is matched against kv keys exactly, then after
+normalization (case, punctuation, spacing), then after replacing common
+synonyms ("Given Name" = "First Name"). Following FILL_PROMPT, the best
+match level wins, then documents (official papers) over forms (self-
+reported). file_lib entries carry no dates, so FILL_PROMPT's "most recent
+document" rule cannot be applied here: a field whose best candidates
+disagree is left to the LLM, as is a date field whose value cannot be
+standardized to YYYY-MM-DD.
+"""
+
+import re
+from datetime import datetime
+
+EXACT, NORMALIZED, SYNONYM = range(3)
+SOURCE_PRIORITY = {"doc": 0, "form": 1}
+
+PHRASE_SYNONYMS = {
+    "given name": "first name",
+    "given names": "first name",
+    "forename": "first name",
+    "surname": "last name",
+    "family name": "last name",
+    "birth date": "date of birth",
+    "birthday": "date of birth",
+    "dob": "date of birth",
+    "sex": "gender",
+    "e mail": "email",
+    "email address": "email",
+    "mobile number": "phone number",
+    "mobile phone number": "phone number",
+    "telephone number": "phone number",
+    "tel": "phone number",
+    "phone no": "phone number",
+    "expiry date": "expiration date",
+    "date of expiry": "expiration date",
+    "issue date": "date of issue",
+    "passport no": "document number",
+}
+KEY_SYNONYMS = {
+    "zip code": "postal code zip code",
+    "zip": "postal code zip code",
+    "postal code": "postal code zip code",
+    "postcode": "postal code zip code",
+    "mobile": "phone number",
+    "phone": "phone number",
+    "telephone": "phone number",
+}
+PHRASE_PATTERN = re.compile(
+    r"\b("
+    + "|".join(
+        re.escape(phrase)
+        for phrase in sorted(PHRASE_SYNONYMS, key=len, reverse=True)
+    )
+    + r")\b"
+)
+
+DATE_FORMATS = [
+    "%Y-%m-%d",
+    "%Y/%m/%d",
+    "%Y.%m.%d",
+    "%Y%m%d",
+    "%b %d, %Y",
+    "%B %d, %Y",
+    "%d %b %Y",
+    "%d %B %Y",
+    "%Y年%m月%d日",
+]
+DATE_PART_SUFFIXES = ("year", "month", "day")
+DATE_WORD = re.compile(r"\bdates?\b")
+
+
+def normalize(name):
+    return " ".join(re.sub(r"[\W_]+", " ", name.casefold()).split())
+
+
+def canonical(name):
+    name = PHRASE_PATTERN.sub(
+        lambda m: PHRASE_SYNONYMS[m.group(1)], normalize(name)
+    )
+    return KEY_SYNONYMS.get(name, name)
+
+
+def is_full_date_field(name):
+    name = canonical(name)
+    if name.endswith(DATE_PART_SUFFIXES):
+        return False
+    return bool(DATE_WORD.search(name)) or name.startswith(
+        ("valid from", "valid until", "cardholder since")
+    )
+
+
+def standardize_date(value):
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return None
+
+
+def build_index(file_lib):
+    """Map kv keys, per match level, to their candidate values"""
+    index = ({}, {}, {})
+    for kind, priority in SOURCE_PRIORITY.items():
+        for entry in file_lib.get(kind, []):
+            if not isinstance(entry, dict) or "id" not in entry:
+                continue
+            kv = entry.get("kv")
+            if not isinstance(kv, dict):
+                continue
+            for key, value in kv.items():
+                if isinstance(value, bool) or not isinstance(
+                    value, (str, int, float)
+                ):
+                    continue
+                value = str(value).strip()
+                if not value:
+                    continue
+                candidate = {
+                    "priority": priority,
+                    "value": value,
+                    "source": {"type": kind, "resource_id": entry["id"]},
+                }
+                for level, name in enumerate(
+                    [key, normalize(key), canonical(key)]
+                ):
+                    index[level].setdefault(name, []).append(candidate)
+    return index
+
+
+def pick(candidates):
+    """The best candidate, or None when the best ones conflict"""
+    best = min(c["priority"] for c in candidates)
+    candidates = [c for c in candidates if c["priority"] == best]
+    if len({c["value"] for c in candidates}) == 1:
+        return candidates[0]
+    return None
+
+
+def resolve_field(field, index):
+    for level, name in enumerate([field, normalize(field), canonical(field)]):
+        candidates = index[level].get(name)
+        if not candidates:
+            continue
+        candidate = pick(candidates)
+        if candidate is None:
+            return None
+        value = candidate["value"]
+        if is_full_date_field(field):
+            value = standardize_date(value)
+            if value is None:
+                return None
+        return {"value": value, "source": dict(candidate["source"])}
+    return None
+
+
+def prefill_form(form_obj, index):
+    """Fill what the index resolves; returns (prefilled, form for the LLM).
+
+    The form for the LLM lists only the unresolved fields, and is None when
+    every field was resolved. Forms without a fields list are returned
+    unchanged.
+    """
+    fields = form_obj.get("fields") if isinstance(form_obj, dict) else None
+    if not isinstance(fields, list):
+        return {}, form_obj
+    prefilled = {}
+    remaining = []
+    for field in fields:
+        entry = resolve_field(field, index) if isinstance(field, str) else None
+        if entry is None:
+            remaining.append(field)
+        else:
+            prefilled[field] = entry
+    if not prefilled:
+        return {}, form_obj
+    if not remaining:
+        return prefilled, None
+    return prefilled, dict(form_obj, fields=remaining)
@@ -0,0 +1,14 @@
+"""Gunicorn settings: gunicorn -c gunicorn.conf.py "app:create_app()" """
+
+bind = "0.0.0.0:5000"
+workers = 4
+threads = 20
+# Import the app once in the master so workers share the parsed RSA key
+# and imported modules; each worker then starts its own runtime.
+preload_app = True
+
+
+def post_worker_init(worker):
+    import app
+
+    app.start_runtime()
@@ -0,0 +1,482 @@
+"""Model routing, hedged requests and fallback for LLM calls.
+
+A provider turns (model, prompt) into raw completion text, optionally
+streamed, and may offer a batch interface (submit_batch / poll_batch) for
+bulk work. The router picks a model per task, issues a hedged duplicate
+when the first attempt is slower than the model's recent latency
+percentile, and falls back to the next model when an attempt fails.
+"""
+
+import io
+import json
+import logging
+import random
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from concurrency_limit import AdaptiveLimiter, classify_failure
+from profiler import bind
+
+logger = logging.getLogger(__name__)
+
+HEDGE_PERCENTILE = 0.9
+MIN_HEDGE_DELAY = 2.0
+MAX_HEDGE_DELAY = 60.0
+MIN_SAMPLES_FOR_HEDGE = 10
+LATENCY_WINDOW = 200
+FAILURE_RATE_DEMOTE = 0.5
+POLL_INTERVAL = 1.0
+
+
+class LLMCancelled(Exception):
+    pass
+
+
+class LLMBatchFailed(Exception):
+    """The provider will never complete this batch"""
+
+
+def abort_on_cancel(response, cancel_event, finished, lock):
+    """Shut the socket of a streaming response down once cancel_event is set.
+
+    Closing the response from another thread does not wake a read blocked
+    on a stalled stream, which would hold its thread and limiter slot until
+    the client's read timeout; shutting the socket down does.
+    """
+    while not cancel_event.wait(POLL_INTERVAL):
+        if finished.is_set():
+            return
+    with lock:
+        if finished.is_set():
+            return
+        stream = response.extensions.get("network_stream")
+        sock = stream.get_extra_info("socket") if stream else None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class ZhipuProvider:
+    """Zhipu async-completion API: submit, then poll for the result"""
+
+    def __init__(self, api_key):
+        from zhipuai import ZhipuAI
+
+        self.client = ZhipuAI(api_key=api_key)
+
+    def complete(self, model, prompt, cancel_event):
+        response = self.client.chat.asyncCompletions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0,
+            response_format={"type": "json_object"},
+            thinking={"type": "disabled"},
+        )
+        task_id = response.id
+        while True:
+            if cancel_event.is_set():
+                raise LLMCancelled()
+            result_response = (
+                self.client.chat.asyncCompletions.retrieve_completion_result(
+                    id=task_id
+                )
+            )
+            if result_response.task_status == "SUCCESS":
+                return result_response.choices[0].message.content
+            elif result_response.task_status == "FAILED":
+                raise Exception("LLM processing failed")
+            cancel_event.wait(POLL_INTERVAL)
+
+    def stream(self, model, prompt, cancel_event):
+        """Yield completion text deltas from the streaming chat API"""
+        response = self.client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0,
+            response_format={"type": "json_object"},
+            thinking={"type": "disabled"},
+            stream=True,
+        )
+        finished = threading.Event()
+        lock = threading.Lock()
+        threading.Thread(
+            target=abort_on_cancel,
+            args=(response.response, cancel_event, finished, lock),
+            daemon=True,
+        ).start()
+        try:
+            for chunk in response:
+                if cancel_event.is_set():
+                    raise LLMCancelled()
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except Exception:
+            if cancel_event.is_set():
+                raise LLMCancelled()
+            raise
+        finally:
+            with lock:
+                finished.set()
+            response.response.close()
+
+    def submit_batch(self, model, prompts):
+        """Submit {custom_id: prompt} to the batch API; returns a batch id"""
+        lines = [
+            json.dumps(
+                {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v4/chat/completions",
+                    "body": {
+                        "model": model,
+                        "messages": [{"role": "user", "content": prompt}],
+                        "temperature": 0,
+                        "response_format": {"type": "json_object"},
+                        "thinking": {"type": "disabled"},
+                    },
+                },
+                ensure_ascii=False,
+            )
+            for custom_id, prompt in prompts.items()
+        ]
+        batch_file = self.client.files.create(
+            file=("batch.jsonl", io.BytesIO("\n".join(lines).encode())),
+            purpose="batch",
+        )
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v4/chat/completions",
+            completion_window="24h",
+        )
+        return batch.id
+
+    def poll_batch(self, batch_id):
+        """Return None while running, else {custom_id: output or None}"""
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status in ["failed", "expired", "cancelled"]:
+            raise LLMBatchFailed(f"Batch {batch_id} {batch.status}")
+        if batch.status != "completed":
+            return None
+        outputs = {}
+        if batch.output_file_id:
+            content = self.client.files.content(batch.output_file_id).content
+            for line in content.decode("utf-8").splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                response = item.get("response") or {}
+                try:
+                    outputs[item["custom_id"]] = response["body"]["choices"][
+                        0
+                    ]["message"]["content"]
+                except (KeyError, IndexError, TypeError):
+                    outputs[item["custom_id"]] = None
+        return outputs
+
+
+class FakeProvider:
+    """Local provider for testing; no network access.
+
+    Returns a fixed JSON object valid for doc, form and fill tasks after a
+    per-model latency, and fails with the given probability. Batches are
+    kept in memory and finish after the same latency.
+    """
+
+    def __init__(self, latency=None, failure_rate=0.0, output=None):
+        self.latency = latency or {}
+        self.failure_rate = failure_rate
+        self.batches = {}
+        self.output = output or {
+            "title": "Fake Document",
+            "tags": ["Fake"],
+            "description": "Output of the local fake LLM provider.",
+            "kv": {"Document Type": "Fake"},
+            "fields": [],
+            "related": [],
+        }
+
+    def complete(self, model, prompt, cancel_event):
+        if cancel_event.wait(self.latency.get(model, 0.05)):
+            raise LLMCancelled()
+        if random.random() < self.failure_rate:
+            raise Exception(f"Fake failure from {model}")
+        return json.dumps(self.output)
+
+    def stream(self, model, prompt, cancel_event):
+        output = self.complete(model, prompt, cancel_event)
+        for i in range(0, len(output), 16):
+            if cancel_event.wait(0.01):
+                raise LLMCancelled()
+            yield output[i : i + 16]
+
+    def submit_batch(self, model, prompts):
+        batch_id = uuid.uuid4().hex
+        self.batches[batch_id] = (
+            time.monotonic() + self.latency.get(model, 0.05),
+            {custom_id: json.dumps(self.output) for custom_id in prompts},
+        )
+        return batch_id
+
+    def poll_batch(self, batch_id):
+        if batch_id not in self.batches:
+            raise LLMBatchFailed(f"Unknown batch {batch_id}")
+        ready_at, outputs = self.batches[batch_id]
+        if time.monotonic() < ready_at:
+            return None
+        return outputs
+
+
+class LatencyStats:
+    """Rolling per-model latency and failure statistics"""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.outcomes = {}
+
+    def _series(self, model):
+        if model not in self.latencies:
+            self.latencies[model] = deque(maxlen=self.window)
+            self.outcomes[model] = deque(maxlen=self.window)
+        return self.latencies[model], self.outcomes[model]
+
+    def record_success(self, model, seconds):
+        with self.lock:
+            latencies, outcomes = self._series(model)
+            latencies.append(seconds)
+            outcomes.append(True)
+
+    def record_failure(self, model):
+        with self.lock:
+            _, outcomes = self._series(model)
+            outcomes.append(False)
+
+    def percentile(self, model, p):
+        with self.lock:
+            values = sorted(self.latencies.get(model, ()))
+        if len(values) < MIN_SAMPLES_FOR_HEDGE:
+            return None
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    def failure_rate(self, model):
+        with self.lock:
+            outcomes = self.outcomes.get(model)
+            if not outcomes:
+                return 0.0
+            return outcomes.count(False) / len(outcomes)
+
+    def snapshot(self):
+        models = list(self.latencies)
+        return {
+            model: {
+                "p50": self.percentile(model, 0.5),
+                "p90": self.percentile(model, 0.9),
+                "failure_rate": self.failure_rate(model),
+                "samples": len(self.latencies[model]),
+            }
+            for model in models
+        }
+
+
+class LLMRouter:
+    """Pick a model per task, hedge slow attempts and fall back on failure.
+
+    routes is a list of rules checked in order; the first rule whose
+    conditions all hold names the primary model. Supported conditions are
+    "type", "max_pages" and "max_prompt_chars". fallback_models are tried
+    after the primary, fastest observed first.
+
+    Calls to each model go through an AdaptiveLimiter created from
+    concurrency = (initial, min, max), which shrinks on provider errors and
+    Retry-After and grows back while calls succeed.
+
+    Attempts run on a pool of max_workers threads, by default enough for
+    every model to reach its maximum concurrency. Callers that know how
+    many tasks call at once should size it to twice that, so each task's
+    hedge never waits behind other tasks' attempts.
+    """
+
+    def __init__(
+        self,
+        provider,
+        routes,
+        default_model,
+        fallback_models=(),
+        concurrency=(8, 1, 32),
+        max_workers=None,
+    ):
+        self.provider = provider
+        self.routes = routes
+        self.default_model = default_model
+        self.fallback_models = list(fallback_models)
+        self.concurrency = concurrency
+        self.stats = LatencyStats()
+        self.limiters = {}
+        self.limiters_lock = threading.Lock()
+        if max_workers is None:
+            models = {rule["model"] for rule in routes}
+            models.update(self.fallback_models + [default_model])
+            max_workers = concurrency[2] * len(models)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="llm"
+        )
+
+    def limiter(self, model):
+        with self.limiters_lock:
+            if model not in self.limiters:
+                initial, min_limit, max_limit = self.concurrency
+                # Completion time scales with output length, so only errors
+                # and Retry-After drive the LLM limits, not latency.
+                self.limiters[model] = AdaptiveLimiter(
+                    f"llm:{model}",
+                    initial,
+                    min_limit,
+                    max_limit,
+                    latency_tolerance=None,
+                )
+            return self.limiters[model]
+
+    def route(self, task_type, pages, prompt_chars):
+        for rule in self.routes:
+            if "type" in rule and rule["type"] != task_type:
+                continue
+            if "max_pages" in rule and pages > rule["max_pages"]:
+                continue
+            if (
+                "max_prompt_chars" in rule
+                and prompt_chars > rule["max_prompt_chars"]
+            ):
+                continue
+            return rule["model"]
+        return self.default_model
+
+    def choose_models(self, task_type, pages, prompt_chars):
+        primary = self.route(task_type, pages, prompt_chars)
+        fallbacks = [
+            model
+            for model in dict.fromkeys(
+                self.fallback_models + [self.default_model]
+            )
+            if model != primary
+        ]
+        fallbacks.sort(
+            key=lambda model: self.stats.percentile(model, 0.5) or float("inf")
+        )
+        models = [primary] + fallbacks
+        healthy = [
+            model
+            for model in models
+            if self.stats.failure_rate(model) < FAILURE_RATE_DEMOTE
+        ]
+        return healthy + [model for model in models if model not in healthy]
+
+    def hedge_delay(self, model):
+        delay = self.stats.percentile(model, HEDGE_PERCENTILE)
+        if delay is None:
+            return MAX_HEDGE_DELAY
+        return min(MAX_HEDGE_DELAY, max(MIN_HEDGE_DELAY, delay))
+
+    def _attempt(self, model, prompt, attempt_cancel, on_delta=None):
+        limiter = self.limiter(model)
+        if not limiter.acquire(attempt_cancel):
+            raise LLMCancelled()
+        start = time.monotonic()
+        try:
+            if on_delta is not None and hasattr(self.provider, "stream"):
+                output = ""
+                for delta in self.provider.stream(
+                    model, prompt, attempt_cancel
+                ):
+                    output += delta
+                    on_delta(output)
+            else:
+                output = self.provider.complete(model, prompt, attempt_cancel)
+        except LLMCancelled:
+            limiter.release()
+            raise
+        except Exception as e:
+            overload, retry_after = classify_failure(e)
+            limiter.release(overload=overload, retry_after=retry_after)
+            self.stats.record_failure(model)
+            raise
+        latency = time.monotonic() - start
+        limiter.release(latency)
+        self.stats.record_success(model, latency)
+        return output
+
+    def _hedged(self, model, hedge_model, prompt, cancel_event, on_delta):
+        attempts = {}
+
+        def launch(attempt_model, on_delta=None):
+            attempt_cancel = threading.Event()
+            future = self.executor.submit(
+                bind(self._attempt),
+                attempt_model,
+                prompt,
+                attempt_cancel,
+                on_delta,
+            )
+            attempts[future] = (attempt_model, attempt_cancel)
+
+        # Only the first attempt streams, so partial output never interleaves.
+        launch(model, on_delta)
+        hedge_at = time.monotonic() + self.hedge_delay(model)
+        hedged = False
+        error = None
+        try:
+            while attempts:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise LLMCancelled()
+                timeout = POLL_INTERVAL
+                if not hedged:
+                    timeout = min(timeout, max(0, hedge_at - time.monotonic()))
+                done, _ = wait(
+                    list(attempts),
+                    timeout=timeout,
+                    return_when=FIRST_COMPLETED,
+                )
+                for future in done:
+                    attempt_model, _ = attempts.pop(future)
+                    try:
+                        return attempt_model, future.result()
+                    except Exception as e:
+                        logger.warning(f"LLM attempt on {attempt_model}: {e}")
+                        error = e
+                if not hedged and attempts and time.monotonic() >= hedge_at:
+                    logger.info(f"Hedging slow {model} with {hedge_model}")
+                    launch(hedge_model)
+                    hedged = True
+            raise error
+        finally:
+            for _, attempt_cancel in attempts.values():
+                attempt_cancel.set()
+
+    def complete(
+        self, prompt, task_type, pages=0, cancel_event=None, on_delta=None
+    ):
+        """Return (model, raw completion text) for the prompt.
+
+        on_delta, if given, is called with the text received so far while
+        the first attempt streams.
+        """
+        models = self.choose_models(task_type, pages, len(prompt))
+        error = None
+        for i, model in enumerate(models):
+            hedge_model = models[i + 1] if i + 1 < len(models) else model
+            try:
+                return self._hedged(
+                    model, hedge_model, prompt, cancel_event, on_delta
+                )
+            except LLMCancelled:
+                raise
+            except Exception as e:
+                logger.error(f"LLM model {model} failed: {e}")
+                error = e
+        raise error
@@ -0,0 +1,198 @@
+"""Pool of CnOCR endpoints with balancing, health probes and circuit breakers.
+
+Each page goes to the admitted endpoint with the fewest outstanding
+requests. An endpoint is ejected (its breaker opens) after
+BREAKER_FAILURES consecutive failed requests or probes, and is re-admitted
+through a single trial request or probe once its cooldown has passed. The
+cooldown doubles each time the trial fails, up to MAX_BREAKER_COOLDOWN. A
+failed page is retried on another endpoint. When every endpoint is
+ejected, pages are spread over all of them rather than failed outright.
+"""
+
+import logging
+import random
+import threading
+import time
+from io import BytesIO
+
+import requests
+
+from concurrency_limit import classify_failure
+
+logger = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = 3
+READ_TIMEOUT = 60
+PROBE_INTERVAL = 5
+PROBE_TIMEOUT = 2
+BREAKER_FAILURES = 3
+BREAKER_COOLDOWN = 10
+MAX_BREAKER_COOLDOWN = 300
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class OCREndpoint:
+    def __init__(self, prefix):
+        self.prefix = prefix.rstrip("/")
+        self.state = CLOSED
+        self.outstanding = 0
+        self.failures = 0
+        self.cooldown = BREAKER_COOLDOWN
+        self.opened_at = 0.0
+        self.trial_running = False
+        self.requests = 0
+        self.errors = 0
+
+    def admits(self, now):
+        """Whether a new request may go here; may move OPEN to HALF_OPEN"""
+        if self.state == OPEN and now - self.opened_at >= self.cooldown:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            return not self.trial_running
+        return self.state == CLOSED
+
+    def record_success(self):
+        if self.state != CLOSED:
+            logger.info(f"OCR endpoint {self.prefix} re-admitted")
+        self.state = CLOSED
+        self.failures = 0
+        self.cooldown = BREAKER_COOLDOWN
+
+    def record_failure(self, now):
+        self.failures += 1
+        if self.state == HALF_OPEN:
+            self.cooldown = min(MAX_BREAKER_COOLDOWN, self.cooldown * 2)
+            self.open(now)
+        elif self.state == CLOSED and self.failures >= BREAKER_FAILURES:
+            self.open(now)
+
+    def open(self, now):
+        if self.state != OPEN:
+            logger.warning(
+                f"OCR endpoint {self.prefix} ejected for {self.cooldown}s"
+            )
+        self.state = OPEN
+        self.opened_at = now
+        self.trial_running = False
+
+    def snapshot(self):
+        return {
+            "state": self.state,
+            "outstanding": self.outstanding,
+            "consecutive_failures": self.failures,
+            "requests": self.requests,
+            "errors": self.errors,
+        }
+
+
+class OCRPool:
+    def __init__(self, prefixes):
+        if not prefixes:
+            raise ValueError("At least one OCR endpoint is required")
+        self.endpoints = [OCREndpoint(prefix) for prefix in prefixes]
+        self.lock = threading.Lock()
+        self.prober = None
+
+    def _pick(self, exclude):
+        with self.lock:
+            now = time.monotonic()
+            candidates = [
+                e for e in self.endpoints if e not in exclude and e.admits(now)
+            ]
+            if not candidates:
+                # Every endpoint is ejected: better a slow try than none.
+                candidates = [e for e in self.endpoints if e not in exclude]
+            if not candidates:
+                return None
+            least = min(e.outstanding for e in candidates)
+            endpoint = random.choice(
+                [e for e in candidates if e.outstanding == least]
+            )
+            if endpoint.state == HALF_OPEN:
+                endpoint.trial_running = True
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def _finish(self, endpoint, error=None):
+        with self.lock:
+            endpoint.outstanding -= 1
+            if endpoint.state == HALF_OPEN:
+                endpoint.trial_running = False
+            if error is None:
+                endpoint.record_success()
+            else:
+                endpoint.errors += 1
+                endpoint.record_failure(time.monotonic())
+
+    def ocr(self, image_bytes):
+        """POST one image to /ocr, failing over to other endpoints"""
+        tried = []
+        error = None
+        while True:
+            endpoint = self._pick(tried)
+            if endpoint is None:
+                raise error
+            tried.append(endpoint)
+            try:
+                r = requests.post(
+                    f"{endpoint.prefix}/ocr",
+                    files={"image": ("", BytesIO(image_bytes), "image/png")},
+                    timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                )
+                r.raise_for_status()
+                results = r.json()["results"]
+            except Exception as e:
+                overload, _ = classify_failure(e)
+                if not overload:
+                    # The image itself was rejected; another replica won't
+                    # do better and this one is fine.
+                    self._finish(endpoint)
+                    raise
+                self._finish(endpoint, e)
+                logger.warning(f"OCR on {endpoint.prefix} failed: {str(e)}")
+                error = e
+                continue
+            self._finish(endpoint)
+            return results
+
+    def probe(self):
+        """Check every endpoint that is closed or due for re-admission"""
+        for endpoint in self.endpoints:
+            with self.lock:
+                now = time.monotonic()
+                if not endpoint.admits(now):
+                    continue
+                if endpoint.state == HALF_OPEN:
+                    endpoint.trial_running = True
+            try:
+                requests.get(
+                    f"{endpoint.prefix}/", timeout=PROBE_TIMEOUT
+                ).raise_for_status()
+            except Exception as e:
+                logger.warning(f"OCR probe of {endpoint.prefix}: {str(e)}")
+                with self.lock:
+                    if endpoint.state == HALF_OPEN:
+                        endpoint.trial_running = False
+                    endpoint.record_failure(time.monotonic())
+                continue
+            with self.lock:
+                if endpoint.state == HALF_OPEN:
+                    endpoint.trial_running = False
+                endpoint.record_success()
+
+    def start_probes(self):
+        def run():
+            while True:
+                self.probe()
+                time.sleep(PROBE_INTERVAL)
+
+        self.prober = threading.Thread(target=run, daemon=True)
+        self.prober.start()
+
+    def snapshot(self):
+        with self.lock:
+            return {e.prefix: e.snapshot() for e in self.endpoints}
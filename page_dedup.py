@@ -0,0 +1,175 @@
+"""Blank and near-duplicate page detection, so each page is OCR-ed once.
+
+Byte-identical pages are always caught. With numpy and Pillow, pages are
+also compared by a 256-bit difference hash (dHash) of their grayscale
+image, which survives re-encoding, rescaling and small lighting changes,
+and pages without ink are blank candidates. The distances of all page
+pairs are computed at once.
+
+A blank candidate is only under BLANK_MAX_INK of ink at BLANK_WIDTH
+pixels wide, which a page with a line or two of small text also is. It
+counts as blank only if no VERIFY_WINDOW square of its ink at
+VERIFY_WIDTH holds more than BLANK_MAX_WINDOW_INK pixels: specks and
+punctuation stay under that, a single letter or digit does not.
+
+A whole-page hash only sees the layout: pages of one form that differ in
+a name, an amount or a page number hash a bit or two apart. A hash match
+is therefore only a candidate. It counts as a duplicate only if the ink
+of the two pages, compared at VERIFY_WIDTH pixels wide (at most the
+narrower page's width) with one pixel of alignment slack, differs by at
+most VERIFY_MAX_WINDOW_DIFF pixels in every VERIFY_WINDOW square. A
+changed character differs by far more; at 1536 pixels across an A4 page,
+so does a comma turned into a period.
+Pages that cannot be decoded are left for OCR to judge.
+"""
+
+import hashlib
+from io import BytesIO
+
+try:
+    import numpy as np
+    from PIL import Image, ImageFilter, ImageOps
+except ImportError:
+    np = None
+
+HASH_SIZE = 16
+DUPLICATE_MAX_DISTANCE = 12
+BLANK_WIDTH = 256
+# A pixel is ink when it is this much darker than its blurred surroundings.
+INK_CONTRAST = 40
+BLANK_MAX_INK = 0.002
+VERIFY_WIDTH = 1536
+VERIFY_WINDOW = 16
+VERIFY_MAX_WINDOW_DIFF = 2
+VERIFY_MAX_ASPECT_CHANGE = 0.02
+BLANK_MAX_WINDOW_INK = 24
+
+UNIQUE = "unique"
+DUPLICATE = "duplicate"
+BLANK = "blank"
+
+
+def load_gray(image_bytes):
+    try:
+        with Image.open(BytesIO(image_bytes)) as img:
+            return ImageOps.exif_transpose(img).convert("L")
+    except Exception:
+        return None
+
+
+def ink_mask(gray, width):
+    """Pixels darker than their blurred surroundings, at the given width"""
+    height = max(1, round(gray.height * width / max(1, gray.width)))
+    small = gray.resize((width, height), Image.BILINEAR)
+    background = np.asarray(
+        small.filter(ImageFilter.GaussianBlur(8)), dtype=np.int16
+    )
+    return (background - np.asarray(small, dtype=np.int16)) > INK_CONTRAST
+
+
+def dilate(mask):
+    """Grow a mask by one pixel in every direction"""
+    padded = np.pad(mask, 1)
+    grown = np.zeros_like(mask)
+    for dy in range(3):
+        for dx in range(3):
+            grown |= padded[dy : dy + mask.shape[0], dx : dx + mask.shape[1]]
+    return grown
+
+
+def window_sums(mask):
+    """Ink pixels in every VERIFY_WINDOW square, from the integral image"""
+    total = np.pad(mask.astype(np.int32).cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    n = VERIFY_WINDOW
+    return total[n:, n:] - total[:-n, n:] - total[n:, :-n] + total[:-n, :-n]
+
+
+def is_blank(gray):
+    """Strict check of a blank candidate: no small area holds real ink"""
+    windows = window_sums(ink_mask(gray, VERIFY_WIDTH))
+    return windows.size == 0 or windows.max() <= BLANK_MAX_WINDOW_INK
+
+
+def same_page(image_a, image_b):
+    """Strict check of a hash match: no small area of ink differs"""
+    a = load_gray(image_a)
+    b = load_gray(image_b)
+    if a is None or b is None:
+        return False
+    aspect_a = a.height / max(1, a.width)
+    aspect_b = b.height / max(1, b.width)
+    if abs(aspect_a - aspect_b) > VERIFY_MAX_ASPECT_CHANGE * aspect_a:
+        return False
+    # Upscaling past the smaller page only compares interpolation noise.
+    width = min(VERIFY_WIDTH, a.width, b.width)
+    ink_a = ink_mask(a, width)
+    ink_b = ink_mask(b.resize(a.size, Image.BILINEAR), width)
+    diff = (ink_a & ~dilate(ink_b)) | (ink_b & ~dilate(ink_a))
+    windows = window_sums(diff)
+    return windows.size == 0 or windows.max() <= VERIFY_MAX_WINDOW_DIFF
+
+
+def page_features(image_bytes):
+    """(dHash bits, is blank) of a page, or None if it cannot be decoded"""
+    gray = load_gray(image_bytes)
+    if gray is None:
+        return None
+    candidate = ink_mask(gray, BLANK_WIDTH).mean() <= BLANK_MAX_INK
+    blank = candidate and is_blank(gray)
+    grid = np.asarray(
+        gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR),
+        dtype=np.int16,
+    )
+    return (grid[:, 1:] > grid[:, :-1]).ravel(), blank
+
+
+def classify_pages(pages):
+    """Classify raw page images; returns [(kind, original page index)].
+
+    The index is that of the earlier page a DUPLICATE repeats, else None.
+    """
+    kinds = [(UNIQUE, None)] * len(pages)
+    first_seen = {}
+    for i, page in enumerate(pages):
+        digest = hashlib.sha256(page).digest()
+        if digest in first_seen:
+            kinds[i] = (DUPLICATE, first_seen[digest])
+        else:
+            first_seen[digest] = i
+    if np is None:
+        return kinds
+
+    hashed = []
+    for i, page in enumerate(pages):
+        if kinds[i][0] != UNIQUE:
+            continue
+        features = page_features(page)
+        if features is None:
+            continue
+        bits, blank = features
+        if blank:
+            kinds[i] = (BLANK, None)
+        else:
+            hashed.append((i, bits))
+    for i, (kind, original) in enumerate(kinds):
+        if kind == DUPLICATE and kinds[original][0] == BLANK:
+            kinds[i] = (BLANK, None)
+
+    if len(hashed) < 2:
+        return kinds
+    bits = np.stack([b for _, b in hashed])
+    distances = (bits[:, None, :] != bits[None, :, :]).sum(axis=2)
+    close = distances <= DUPLICATE_MAX_DISTANCE
+    for a, (i, _) in enumerate(hashed):
+        for b in np.flatnonzero(close[a, :a]):
+            original = hashed[b][0]
+            if kinds[original][0] == UNIQUE and same_page(
+                pages[i], pages[original]
+            ):
+                kinds[i] = (DUPLICATE, original)
+                break
+    # Exact copies of a page that turned out to repeat an earlier one.
+    for i, (kind, original) in enumerate(kinds):
+        if kind == DUPLICATE and kinds[original][0] == DUPLICATE:
+            kinds[i] = kinds[original]
+    return kinds
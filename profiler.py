@@ -0,0 +1,191 @@
+"""Sampling profiler for the live process, in collapsed-stack format.
+
+Stacks are read from sys._current_frames() by a background thread, so the
+profiled code runs unmodified and nothing is sampled unless a profile is
+being taken. Output lines are "frame;frame;...;frame count", root first,
+which flamegraph.pl, speedscope and inferno read directly. Each stack is
+prefixed with the thread name, so waits on locks and I/O show up per
+thread next to the code that holds the GIL.
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+MAX_STACK_DEPTH = 128
+
+# The tracked task (profiler, entry) of the current thread, see bind().
+_current = threading.local()
+
+
+def frame_label(frame):
+    code = frame.f_code
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return f"{module}:{code.co_name}:{frame.f_lineno}"
+
+
+def collapse(frame, prefix):
+    labels = []
+    while frame is not None and len(labels) < MAX_STACK_DEPTH:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    labels.append(prefix)
+    return ";".join(reversed(labels))
+
+
+def format_collapsed(counts):
+    return "".join(
+        f"{stack} {count}\n" for stack, count in counts.most_common()
+    )
+
+
+def sample(duration, interval):
+    """Sample every thread but this one for duration seconds"""
+    counts = Counter()
+    own = threading.get_ident()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident != own:
+                counts[collapse(frame, names.get(ident, str(ident)))] += 1
+        time.sleep(interval)
+    return counts
+
+
+class SlowTaskProfiler:
+    """Profile tasks that run longer than threshold seconds.
+
+    A task is registered with track(); once it has run for threshold
+    seconds, its thread is sampled until it finishes, and the stacks are
+    written to out_dir. The profile therefore covers the slow part of the
+    task. Helper threads running callables wrapped with bind() are sampled
+    with the task, each stack rooted at "task;<thread name>". Only the
+    newest max_files profiles are kept.
+    """
+
+    def __init__(self, threshold, interval, out_dir, max_files):
+        self.threshold = threshold
+        self.interval = interval
+        self.out_dir = out_dir
+        self.max_files = max_files
+        self.lock = threading.Lock()
+        self.running = {}
+
+    def start(self):
+        threading.Thread(
+            target=self._run, name="slow-task-profiler", daemon=True
+        ).start()
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            with self.lock:
+                slow = {
+                    ident: entry
+                    for ident, entry in self.running.items()
+                    if now - entry["start"] >= self.threshold
+                }
+            if not slow:
+                time.sleep(min(1.0, self.threshold / 2))
+                continue
+            names = {t.ident: t.name for t in threading.enumerate()}
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, entry in slow.items():
+                    if self.running.get(ident) is not entry:
+                        continue
+                    for thread in entry["threads"]:
+                        if thread in frames:
+                            name = names.get(thread, str(thread))
+                            stack = collapse(frames[thread], f"task;{name}")
+                            entry["counts"][stack] += 1
+            del frames
+            time.sleep(self.interval)
+
+    def track(self, label):
+        return TrackedTask(self, label)
+
+    def finish(self, ident):
+        with self.lock:
+            entry = self.running.pop(ident, None)
+        if not entry or not entry["counts"]:
+            return None
+        seconds = time.monotonic() - entry["start"]
+        os.makedirs(self.out_dir, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+        name = f"{stamp}-{entry['label']}-{seconds:.0f}s.collapsed"
+        with open(os.path.join(self.out_dir, name), "w") as f:
+            f.write(format_collapsed(entry["counts"]))
+        self._prune()
+        return name
+
+    def _prune(self):
+        names = sorted(list_profiles(self.out_dir))
+        for name in names[: max(0, len(names) - self.max_files)]:
+            try:
+                os.remove(os.path.join(self.out_dir, name))
+            except OSError:
+                pass
+
+
+class TrackedTask:
+    def __init__(self, profiler, label):
+        self.profiler = profiler
+        self.label = label
+        self.profile = None
+
+    def __enter__(self):
+        ident = threading.get_ident()
+        entry = {
+            "label": self.label,
+            "start": time.monotonic(),
+            "counts": Counter(),
+            "threads": {ident},
+        }
+        with self.profiler.lock:
+            self.profiler.running[ident] = entry
+        _current.task = (self.profiler, entry)
+        return self
+
+    def __exit__(self, *exc):
+        _current.task = None
+        self.profile = self.profiler.finish(threading.get_ident())
+        return False
+
+
+def bind(func):
+    """Wrap func to be sampled as part of the calling thread's task.
+
+    Call it where work is handed to a thread pool; the helper thread that
+    runs the wrapper then joins the tracked task's profile. Without a
+    tracked task, func is returned unchanged.
+    """
+    task = getattr(_current, "task", None)
+    if task is None:
+        return func
+    profiler, entry = task
+
+    def run(*args, **kwargs):
+        ident = threading.get_ident()
+        with profiler.lock:
+            entry["threads"].add(ident)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with profiler.lock:
+                entry["threads"].discard(ident)
+
+    return run
+
+
+def list_profiles(out_dir):
+    try:
+        return [
+            name for name in os.listdir(out_dir) if name.endswith(".collapsed")
+        ]
+    except OSError:
+        return []
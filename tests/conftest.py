@@ -0,0 +1,9 @@
+"""Run from the project root (needs priv_sets.py and the RSA key pair):
+
+    python -m pytest -q
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,79 @@
+import json
+import struct
+
+import pytest
+
+import app
+
+HEADER = {"client_id": "c1", "type": "doc", "SHA256": "abc"}
+
+
+def envelope(header=HEADER, sections=(), version=1):
+    header = json.dumps(header).encode()
+    body = b"".join(struct.pack(">I", len(s)) + s for s in sections)
+    return (
+        app.ENVELOPE_MAGIC
+        + bytes([version])
+        + struct.pack(">I", len(header))
+        + header
+        + body
+    )
+
+
+def test_parse_sections():
+    raw = envelope(sections=[b"inner", b"", b"page2"])
+    data = app.parse_envelope(raw)
+    assert data["client_id"] == "c1"
+    assert data["envelope_version"] == 1
+    assert [bytes(s) for s in data["sections"]] == [b"inner", b"", b"page2"]
+    assert bytes(data["content"]) == raw[-(3 * 4 + 10) :]
+
+
+def test_sections_are_views_of_the_upload():
+    raw = envelope(sections=[b"x" * 1000])
+    data = app.parse_envelope(raw)
+    assert isinstance(data["sections"][0], memoryview)
+    assert data["sections"][0].obj is raw
+
+
+def test_header_only_has_no_content():
+    data = app.parse_envelope(envelope())
+    assert "content" not in data
+    assert "sections" not in data
+
+
+@pytest.mark.parametrize(
+    "raw",
+    [
+        b"",
+        b"DSNP\x01",
+        b"PK\x03\x04\x01\x00\x00\x00\x02{}",
+        envelope()[:-1],
+        b"DSNP\x01" + struct.pack(">I", 2) + b"{}" + b"\x00\x00",
+        b"DSNP\x01"
+        + struct.pack(">I", 2)
+        + b"{}"
+        + struct.pack(">I", 5)
+        + b"abcd",
+        b"DSNP\x01" + struct.pack(">I", 3) + b"{x}",
+        envelope(header=["not", "a", "dict"]),
+    ],
+    ids=[
+        "empty",
+        "short",
+        "magic",
+        "header overrun",
+        "short section length",
+        "section overrun",
+        "header json",
+        "header type",
+    ],
+)
+def test_invalid_envelope(raw):
+    with pytest.raises(ValueError, match="^INVALID_ENVELOPE$"):
+        app.parse_envelope(raw)
+
+
+def test_unsupported_version():
+    with pytest.raises(ValueError, match="^UNSUPPORTED_ENVELOPE_VERSION$"):
+        app.parse_envelope(envelope(version=2))
@@ -0,0 +1,52 @@
+import pytest
+
+from form_prefill import build_index, is_full_date_field, prefill_form
+
+FILE_LIB = {
+    "doc": [
+        {
+            "id": "d1",
+            "kv": {
+                "Candidate Name": "Zhang San",
+                "Update Reason": "Address change",
+                "Date of Birth": "1990/05/01",
+            },
+        }
+    ],
+    "form": [],
+}
+
+
+@pytest.mark.parametrize(
+    "name", ["Date of Birth", "Issue Date", "Dates", "Valid Until"]
+)
+def test_date_fields(name):
+    assert is_full_date_field(name)
+
+
+@pytest.mark.parametrize(
+    "name",
+    ["Candidate Name", "Update Reason", "Validated By", "Birth Year"],
+)
+def test_not_date_fields(name):
+    assert not is_full_date_field(name)
+
+
+def test_prefill_names_containing_date():
+    form = {"fields": ["Candidate Name", "Update Reason", "DOB"]}
+    prefilled, remaining = prefill_form(form, build_index(FILE_LIB))
+    assert remaining is None
+    assert prefilled == {
+        "Candidate Name": {
+            "value": "Zhang San",
+            "source": {"type": "doc", "resource_id": "d1"},
+        },
+        "Update Reason": {
+            "value": "Address change",
+            "source": {"type": "doc", "resource_id": "d1"},
+        },
+        "DOB": {
+            "value": "1990-05-01",
+            "source": {"type": "doc", "resource_id": "d1"},
+        },
+    }
@@ -0,0 +1,151 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+DOC = {
+    "title": "Receipt",
+    "tags": ["Shopping"],
+    "description": "A grocery receipt.",
+    "kv": {"Total": "12.50"},
+    "related": [],
+}
+
+
+def test_extract_plain_object():
+    assert app.extract_json_object(json.dumps(DOC)) == DOC
+
+
+def test_extract_from_code_fence_and_prose():
+    text = "Here you go:\n```json\n" + json.dumps(DOC) + "\n```\nDone."
+    assert app.extract_json_object(text) == DOC
+
+
+def test_extract_ignores_trailing_text():
+    assert app.extract_json_object('{"a": 1} and {"b": 2}') == {"a": 1}
+
+
+def test_extract_repairs_trailing_comma_and_smart_quotes():
+    text = '{“title”: “X”, "tags": ["a", "b",],}'
+    assert app.extract_json_object(text) == {"title": "X", "tags": ["a", "b"]}
+
+
+def test_extract_repairs_truncated_output():
+    text = '{"title": "X", "kv": {"Total": "12.5'
+    assert app.extract_json_object(text) == {
+        "title": "X",
+        "kv": {"Total": "12.5"},
+    }
+
+
+def test_extract_skips_unparseable_braces():
+    text = 'Use {name} as the key. {"title": "X"}'
+    assert app.extract_json_object(text) == {"title": "X"}
+
+
+@pytest.mark.parametrize("text", ["", "no json here", "[1, 2, 3]"])
+def test_extract_without_object_raises(text):
+    with pytest.raises(ValueError):
+        app.extract_json_object(text)
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ('{"a": 1,}', '{"a": 1}'),
+        ('{"a": [1, 2,]}', '{"a": [1, 2]}'),
+        ('{"a": 1} trailing', '{"a": 1}'),
+        ('{"a": "b', '{"a": "b"}'),
+        ('{"a": ', '{"a": null}'),
+        ('{"a": {"b": [1,', '{"a": {"b": [1]}}'),
+        ('{"a": "x}y"', '{"a": "x}y"}'),
+        ('{"a": "q\\"', '{"a": "q\\""}'),
+    ],
+)
+def test_repair_json(text, expected):
+    assert app.repair_json(text) == expected
+    json.loads(app.repair_json(text))
+
+
+def test_partial_output_before_any_field():
+    assert app.parse_partial_output("") == {}
+    assert app.parse_partial_output('{"title": "Rec') == {}
+
+
+def test_partial_output_keeps_only_completed_fields():
+    text = '<think>{"title": "no"}</think>{"title": "Receipt", "tags": ["a"'
+    assert app.parse_partial_output(text) == {"title": "Receipt"}
+
+
+def test_partial_output_expands_kv():
+    text = '{"kv": {"Buyer": {"Name": "A"}, "Items": ["x", "y"]}, "desc'
+    assert app.parse_partial_output(text) == {
+        "kv": {"Buyer.Name": "A", "Items.1": "x", "Items.2": "y"}
+    }
+
+
+def test_partial_output_drops_unknown_fields():
+    text = '{"related": [], "title": "X"}'
+    assert app.parse_partial_output(text) == {"title": "X"}
+
+
+def test_parse_output_strips_think_tags():
+    text = '<think>{"title": 1}</think>' + json.dumps(DOC)
+    assert app.parse_llm_output(text, "doc") == (DOC, [])
+
+
+def test_parse_output_reports_missing_and_fills_defaults():
+    obj, missing = app.parse_llm_output(
+        json.dumps({"title": "X", "tags": "Single", "kv": []}), "doc"
+    )
+    assert obj == {"title": "X", "tags": ["Single"], "related": []}
+    assert missing == ["description", "kv"]
+
+
+def test_parse_output_fill_keeps_sourced_values():
+    output = {
+        "Name": {"value": "A", "source": {"file": 1}},
+        "Date": {"value": "", "source": {"file": 1}},
+        "Phone": {"value": "123"},
+        "Note": "text",
+    }
+    assert app.parse_llm_output(json.dumps(output), "fill") == (
+        {"Name": output["Name"]},
+        [],
+    )
+
+
+def test_parse_output_without_object_raises():
+    with pytest.raises(ValueError):
+        app.parse_llm_output("I cannot read this document.", "doc")
+
+
+def test_repair_merges_missing_keys(monkeypatch):
+    prompts = []
+
+    def complete(prompt, type, pages, cancel_event=None):
+        prompts.append(prompt)
+        return "model", json.dumps({"description": "D", "title": "Other"})
+
+    monkeypatch.setattr(app, "llm_router", SimpleNamespace(complete=complete))
+    partial = {"title": "X", "tags": [], "kv": {}, "related": []}
+    obj, missing = app.repair_llm_output(
+        "PROMPT", "doc", 1, partial, ["description"]
+    )
+    assert obj == {**partial, "description": "D"}
+    assert missing == []
+    assert prompts[0].startswith("PROMPT" + app.REPAIR_PROMPT)
+
+
+def test_repair_keeps_partial_on_unparseable_output(monkeypatch):
+    def complete(prompt, type, pages, cancel_event=None):
+        return "model", "sorry"
+
+    monkeypatch.setattr(app, "llm_router", SimpleNamespace(complete=complete))
+    partial = {"title": "X"}
+    assert app.repair_llm_output("P", "doc", 1, partial, ["kv"]) == (
+        partial,
+        ["kv"],
+    )
@@ -0,0 +1,92 @@
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont, ImageFilter
+
+from page_dedup import BLANK, DUPLICATE, UNIQUE, classify_pages
+
+# An A4 page at 300 dpi; 42 px is about 10pt text.
+A4 = (2480, 3508)
+FONT = ImageFont.load_default(size=42)
+
+
+def encode(img, fmt="JPEG", **kw):
+    out = BytesIO()
+    img.save(out, fmt, **kw)
+    return out.getvalue()
+
+
+def text_page(lines, size=A4, background=235):
+    img = Image.new("L", size, background)
+    draw = ImageDraw.Draw(img)
+    for i, line in enumerate(lines):
+        draw.text((300, 400 + i * 60), line, fill=30, font=FONT)
+    return img
+
+
+def receipt(payer, amount):
+    return text_page(
+        [
+            "OFFICIAL PAYMENT RECEIPT",
+            "Receipt No. 2024-0001",
+            f"Payer {payer}",
+            f"Amount CNY {amount}",
+            "Method Bank transfer",
+            "Date 2024-05-01",
+        ]
+        + ["-" * 40] * 30
+    )
+
+
+def noisy_blank(seed):
+    rng = np.random.default_rng(seed)
+    shade = np.linspace(200, 245, A4[1])[:, None] * np.ones((1, A4[0]))
+    noise = rng.normal(0, 6, shade.shape)
+    img = Image.fromarray(np.clip(shade + noise, 0, 255).astype("uint8"))
+    return img.filter(ImageFilter.GaussianBlur(0.6))
+
+
+def test_blank_pages():
+    pages = [
+        encode(Image.new("L", A4, 235)),
+        encode(noisy_blank(1), quality=75),
+        encode(text_page(["."]), quality=75),
+    ]
+    assert classify_pages(pages) == [(BLANK, None)] * 3
+
+
+def test_sparse_text_is_not_blank():
+    pages = [
+        encode(text_page(["Total amount due: 12,450.00 EUR"]), quality=75),
+        encode(text_page(["ACME Store", "Milk 1.20", "Total 1.20"])),
+        encode(text_page(["7"]), quality=75),
+    ]
+    assert classify_pages(pages) == [(UNIQUE, None)] * 3
+
+
+def test_copies_are_duplicates():
+    page = receipt("Zhang San", "1,200.00")
+    brighter = page.point(lambda v: min(255, int(v * 0.9 + 30)))
+    pages = [
+        encode(page, "PNG"),
+        encode(page.resize((1240, 1754)), quality=70),
+        encode(brighter, quality=85),
+        encode(page, "PNG"),
+    ]
+    assert classify_pages(pages) == [(UNIQUE, None)] + [(DUPLICATE, 0)] * 3
+
+
+def test_one_digit_change_is_not_duplicate():
+    pages = [
+        encode(receipt("Zhang San", "1,200.00"), "PNG"),
+        encode(receipt("Zhang San", "1,300.00"), "PNG"),
+        encode(receipt("Zhang San", "1.200.00"), "PNG"),
+    ]
+    assert classify_pages(pages) == [(UNIQUE, None)] * 3
+
+
+def test_undecodable_page_is_left_for_ocr():
+    assert classify_pages([b"not an image", b"not an image"]) == [
+        (UNIQUE, None),
+        (DUPLICATE, 0),
+    ]